@@ -24,9 +24,184 @@
 %{
  /* Put header files here or function declarations like below */
 #include <anthy/anthy.h>
+#include <pythread.h>
+
+/* libanthy shares the dictionaries between the contexts so the calls
+ * are serialized with anthy_lock and run without the GIL. */
+static PyThread_type_lock anthy_lock = NULL;
+
+#define ANTHY_BEGIN_CALL \
+    Py_BEGIN_ALLOW_THREADS \
+    PyThread_acquire_lock (anthy_lock, WAIT_LOCK);
+
+#define ANTHY_END_CALL \
+    PyThread_release_lock (anthy_lock); \
+    Py_END_ALLOW_THREADS
+
+/* Copies the nth candidate of the segment, or the nth prediction if seg
+ * is negative, into buf or a new buffer if buf is too small.
+ * This is called without the GIL. */
+static char *
+anthy_context_get_buffer (anthy_context_t ac, int seg, int nth,
+                          char *buf, int size, int *len)
+{
+    if (seg >= 0)
+        *len = anthy_get_segment (ac, seg, nth, NULL, 0);
+    else
+        *len = anthy_get_prediction (ac, nth, NULL, 0);
+    if (*len < 0)
+        return NULL;
+    if (*len >= size)
+        buf = (char *) malloc (*len + 1);
+    if (buf == NULL)
+        return NULL;
+    if (seg >= 0)
+        *len = anthy_get_segment (ac, seg, nth, buf, *len + 1);
+    else
+        *len = anthy_get_prediction (ac, nth, buf, *len + 1);
+    return buf;
+}
+
+/* Returns the nth candidate of the segment, or the nth prediction if seg
+ * is negative, as a string or None. */
+static PyObject *
+anthy_context_get_string (anthy_context_t ac, int seg, int nth)
+{
+    char temp[512];
+    char *buf;
+    int len;
+    PyObject *str;
+
+    ANTHY_BEGIN_CALL
+    buf = anthy_context_get_buffer (ac, seg, nth, temp, sizeof (temp), &len);
+    ANTHY_END_CALL
+
+    if (buf == NULL) {
+        if (len < 0)
+            Py_RETURN_NONE;
+        return PyErr_NoMemory ();
+    }
+    if (len >= 0)
+        str = PyString_FromStringAndSize (buf, len);
+    else {
+        Py_INCREF (Py_None);
+        str = Py_None;
+    }
+    if (buf != temp)
+        free (buf);
+    return str;
+}
+
+/* Returns the strings from start to end as a list. */
+static PyObject *
+anthy_context_strings_to_list (anthy_context_t ac, int seg,
+                               int start, int end, int nr)
+{
+    PyObject *list;
+    PyObject *str;
+    int i;
+
+    if (start < 0)
+        start = 0;
+    if (end < 0 || end > nr)
+        end = nr;
+    list = PyList_New (0);
+    if (list == NULL)
+        return NULL;
+    for (i = start; i < end; i++) {
+        str = anthy_context_get_string (ac, seg, i);
+        if (str == NULL) {
+            Py_DECREF (list);
+            return NULL;
+        }
+        if (str == Py_None) {
+            Py_DECREF (str);
+            break;
+        }
+        PyList_Append (list, str);
+        Py_DECREF (str);
+    }
+    return list;
+}
+
+/* Joins the segments from seg to the last one with one resize.
+ * This is called without the GIL. */
+static void
+anthy_context_join_segments (anthy_context_t ac, int seg)
+{
+    struct anthy_conv_stat conv_stat;
+    struct anthy_segment_stat seg_stat;
+    int first = 0;
+    int len = 0;
+    int i;
+
+    if (anthy_get_stat (ac, &conv_stat) < 0)
+        return;
+    if (conv_stat.nr_segment - seg <= 1)
+        return;
+    for (i = seg; i < conv_stat.nr_segment; i++) {
+        if (anthy_get_segment_stat (ac, i, &seg_stat) < 0)
+            return;
+        if (i == seg)
+            first = seg_stat.seg_len;
+        len += seg_stat.seg_len;
+    }
+    anthy_resize_segment (ac, seg, len - first);
+}
+
+/* Returns (candidate, reading, nr_candidate) of the segments from start. */
+static PyObject *
+anthy_context_segments_to_list (anthy_context_t ac, int start)
+{
+    struct anthy_conv_stat conv_stat;
+    struct anthy_segment_stat seg_stat;
+    PyObject *list;
+    PyObject *candidate;
+    PyObject *reading;
+    PyObject *item;
+    int retval;
+    int i;
+
+    ANTHY_BEGIN_CALL
+    retval = anthy_get_stat (ac, &conv_stat);
+    ANTHY_END_CALL
+    if (retval < 0)
+        conv_stat.nr_segment = 0;
+    if (start < 0)
+        start = 0;
+    list = PyList_New (0);
+    if (list == NULL)
+        return NULL;
+    for (i = start; i < conv_stat.nr_segment; i++) {
+        ANTHY_BEGIN_CALL
+        retval = anthy_get_segment_stat (ac, i, &seg_stat);
+        ANTHY_END_CALL
+        if (retval < 0)
+            seg_stat.nr_candidate = 0;
+        candidate = anthy_context_get_string (ac, i, 0);
+        reading = anthy_context_get_string (ac, i, NTH_UNCONVERTED_CANDIDATE);
+        if (candidate == NULL || reading == NULL) {
+            Py_XDECREF (candidate);
+            Py_XDECREF (reading);
+            Py_DECREF (list);
+            return NULL;
+        }
+        item = Py_BuildValue ("(NNi)", candidate, reading,
+                              seg_stat.nr_candidate);
+        if (item == NULL) {
+            Py_DECREF (list);
+            return NULL;
+        }
+        PyList_Append (list, item);
+        Py_DECREF (item);
+    }
+    return list;
+}
 %}
 
 %init %{
+    PyEval_InitThreads ();
+    anthy_lock = PyThread_allocate_lock ();
     anthy_init ();
 %}
 
@@ -35,90 +210,193 @@
 struct anthy_context {};
 %extend anthy_context {
     anthy_context () {
-        return anthy_create_context ();
+        anthy_context_t ac;
+
+        ANTHY_BEGIN_CALL
+        ac = anthy_create_context ();
+        ANTHY_END_CALL
+        return ac;
     }
 
     void reset () {
+        ANTHY_BEGIN_CALL
         anthy_reset_context (self);
+        ANTHY_END_CALL
     }
 
     int set_string (char *str) {
-        return anthy_set_string (self, str);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_set_string (self, str);
+        ANTHY_END_CALL
+        return retval;
+    }
+
+    /* Sets the string and returns the segments as get_segments(). */
+    PyObject *set_string_segments (char *str) {
+        ANTHY_BEGIN_CALL
+        anthy_set_string (self, str);
+        ANTHY_END_CALL
+        return anthy_context_segments_to_list (self, 0);
+    }
+
+    /* Sets the string as one segment and returns it as get_segments(). */
+    PyObject *set_string_single (char *str) {
+        ANTHY_BEGIN_CALL
+        anthy_set_string (self, str);
+        anthy_context_join_segments (self, 0);
+        ANTHY_END_CALL
+        return anthy_context_segments_to_list (self, 0);
     }
 
     void resize_segment (int a1, int a2) {
+        ANTHY_BEGIN_CALL
         anthy_resize_segment (self, a1, a2);
+        ANTHY_END_CALL
     }
 
     int get_stat (struct anthy_conv_stat *a1) {
-        return anthy_get_stat (self, a1);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_get_stat (self, a1);
+        ANTHY_END_CALL
+        return retval;
     }
 
     int get_segment_stat (int a1, struct anthy_segment_stat *a2) {
-        return anthy_get_segment_stat (self, a1, a2);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_get_segment_stat (self, a1, a2);
+        ANTHY_END_CALL
+        return retval;
     }
 
-    char *get_segment (int a1, int a2) {
-        int len;
-        static char temp[512];
+    PyObject *get_segment (int a1, int a2) {
+        return anthy_context_get_string (self, a1, a2);
+    }
 
-        len = anthy_get_segment (self, a1, a2, temp, sizeof (temp));
-        if (len >= 0)
-            return temp;
-        else
-            return NULL;
+    /* Returns the candidates from start to end of the segment. */
+    PyObject *get_segment_candidates (int seg, int start = 0, int end = -1) {
+        struct anthy_segment_stat stat;
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_get_segment_stat (self, seg, &stat);
+        ANTHY_END_CALL
+        if (retval < 0)
+            stat.nr_candidate = 0;
+        return anthy_context_strings_to_list (self, seg, start, end,
+                                              stat.nr_candidate);
+    }
+
+    /* Returns (candidate, reading, nr_candidate) of the segments
+     * from start. */
+    PyObject *get_segments (int start = 0) {
+        return anthy_context_segments_to_list (self, start);
     }
 
     int commit_segment (int a1, int a2) {
-        return anthy_commit_segment (self, a1, a2);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_commit_segment (self, a1, a2);
+        ANTHY_END_CALL
+        return retval;
     }
 
     int set_prediction_string (const char *a1) {
-        return anthy_set_prediction_string (self, a1);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_set_prediction_string (self, a1);
+        ANTHY_END_CALL
+        return retval;
     }
 
     int get_prediction_stat (struct anthy_prediction_stat *a1) {
-        return anthy_get_prediction_stat (self, a1);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_get_prediction_stat (self, a1);
+        ANTHY_END_CALL
+        return retval;
     }
 
-    char *get_prediction (int a1) {
-        int len;
-        static char temp[512];
+    PyObject *get_prediction (int a1) {
+        return anthy_context_get_string (self, -1, a1);
+    }
 
-        len = anthy_get_prediction (self, a1, temp, sizeof (temp));
+    /* Returns the predictions from start to end. */
+    PyObject *get_predictions (int start = 0, int end = -1) {
+        struct anthy_prediction_stat stat;
+        int retval;
 
-        if (len >= 0)
-            return temp;
-        else
-            return NULL;
+        ANTHY_BEGIN_CALL
+        retval = anthy_get_prediction_stat (self, &stat);
+        ANTHY_END_CALL
+        if (retval < 0)
+            stat.nr_prediction = 0;
+        return anthy_context_strings_to_list (self, -1, start, end,
+                                              stat.nr_prediction);
     }
 
     int commit_prediction (int a1) {
-        return anthy_commit_prediction(self, a1);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_commit_prediction (self, a1);
+        ANTHY_END_CALL
+        return retval;
     }
 
     void _print () {
+        ANTHY_BEGIN_CALL
         anthy_print_context (self);
+        ANTHY_END_CALL
     }
 
     int _set_encoding (int encoding) {
-        return anthy_context_set_encoding (self, encoding);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_context_set_encoding (self, encoding);
+        ANTHY_END_CALL
+        return retval;
     }
 
     int set_reconversion_mode (int mode) {
-        return anthy_set_reconversion_mode (self, mode);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_set_reconversion_mode (self, mode);
+        ANTHY_END_CALL
+        return retval;
     }
 
     int init_personality (void) {
-        return anthy_init_personality ();
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_init_personality ();
+        ANTHY_END_CALL
+        return retval;
     }
 
     int do_set_personality (const char *id) {
-        return anthy_do_set_personality (id);
+        int retval;
+
+        ANTHY_BEGIN_CALL
+        retval = anthy_do_set_personality (id);
+        ANTHY_END_CALL
+        return retval;
     }
 
     ~anthy_context () {
+        ANTHY_BEGIN_CALL
         anthy_release_context (self);
+        ANTHY_END_CALL
     }
 };
-
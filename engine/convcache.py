@@ -0,0 +1,103 @@
+# vim:set et sts=4 sw=4:
+# -*- coding: utf-8 -*-
+#
+# ibus-anthy - The Anthy engine for IBus
+#
+# Copyright (c) 2007-2008 Peng Huang <shawn.p.huang@gmail.com>
+# Copyright (c) 2007-2011 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# The number of the conversions which are kept in a ConversionCache.
+CONVERSION_CACHE_SIZE = 32
+
+class ConversionSnapshot(object):
+    # segments are the tuples of (candidate, reading, nr_candidate)
+    # which are returned by anthy_context.get_segments() and
+    # candidates are the lists of the first candidates of the segments
+    # if they are loaded.
+    # self.candidates maps (segment, reading) to (nr_candidate,
+    # the candidates which are loaded so far).
+    def __init__(self, segments, candidates=None):
+        self.segments = segments
+        self.candidates = {}
+        for i, (candidate, reading, nr_candidate) in enumerate(segments):
+            if candidates != None:
+                loaded = list(candidates[i])
+            else:
+                loaded = [candidate]
+            self.candidates[(i, unicode(reading, "utf-8"))] = \
+                (nr_candidate, loaded)
+
+    # Returns the candidates which can be changed without
+    # changing the snapshot.
+    def copy_candidates(self):
+        return dict((k, (nr_candidate, list(candidates)))
+                    for k, (nr_candidate, candidates)
+                    in self.candidates.items())
+
+
+class ConversionCache(object):
+    # The least recently used snapshot is dropped when the cache is full.
+    def __init__(self, size=CONVERSION_CACHE_SIZE):
+        self.__size = size
+        self.__snapshots = {}
+        self.__keys = []
+        self.__hits = 0
+        self.__misses = 0
+
+    def __len__(self):
+        return len(self.__snapshots)
+
+    def __contains__(self, key):
+        return key in self.__snapshots
+
+    def get(self, key):
+        snapshot = self.__snapshots.get(key, None)
+        if snapshot == None:
+            self.__misses += 1
+            return None
+        self.__hits += 1
+        self.__keys.remove(key)
+        self.__keys.append(key)
+        return snapshot
+
+    def add(self, key, snapshot):
+        if key in self.__snapshots:
+            self.__keys.remove(key)
+        elif len(self.__keys) >= self.__size:
+            del self.__snapshots[self.__keys.pop(0)]
+        self.__snapshots[key] = snapshot
+        self.__keys.append(key)
+
+    def remove(self, key):
+        if key in self.__snapshots:
+            del self.__snapshots[key]
+            self.__keys.remove(key)
+
+    # The snapshots are dropped when the user dictionary or
+    # the learning data is changed.
+    def clear(self):
+        self.__snapshots.clear()
+        del self.__keys[:]
+
+    def get_hit_rate(self):
+        total = self.__hits + self.__misses
+        if total == 0:
+            return 0.0
+        return float(self.__hits) / total
+
+    def get_stats(self):
+        return self.__hits, self.__misses, len(self.__snapshots)
@@ -0,0 +1,292 @@
+# vim:set et sts=4 sw=4:
+# -*- coding: utf-8 -*-
+#
+# ibus-anthy - The Anthy engine for IBus
+#
+# Copyright (c) 2007-2008 Peng Huang <shawn.p.huang@gmail.com>
+# Copyright (c) 2007-2011 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import cPickle
+import errno
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+import traceback
+import gobject
+
+# The requests which are not answered in time are failed and the server
+# is restarted since libanthy does not return until it is done.
+CONVERSION_SERVER_TIMEOUT = 2000
+# The server is not restarted any more if it crashes this many times
+# in CONVERSION_SERVER_RESTART_PERIOD seconds.
+CONVERSION_SERVER_MAX_RESTARTS = 5
+CONVERSION_SERVER_RESTART_PERIOD = 60
+
+_HEADER = struct.Struct("!I")
+_SERVER_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+def _pack(message):
+    buf = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(buf)) + buf
+
+# Returns the messages in buf and the rest of buf.
+def _parse(buf):
+    messages = []
+    size = _HEADER.size
+    while len(buf) >= size:
+        length = _HEADER.unpack(buf[:size])[0]
+        if len(buf) < size + length:
+            break
+        messages.append(cPickle.loads(buf[size:size + length]))
+        buf = buf[size + length:]
+    return messages, buf
+
+class ConversionServer(object):
+    # A subprocess with its own anthy context runs the requests in order
+    # and the results come back over a unix socket in the main loop.
+    # A crash of libanthy does not take the engine down and the server
+    # is started again.  The socket is non-blocking so that the main
+    # loop does not wait for the server.
+    def __init__(self, timeout=CONVERSION_SERVER_TIMEOUT):
+        self.__timeout = timeout
+        self.__process = None
+        self.__socket = None
+        self.__watch_id = 0
+        self.__write_id = 0
+        self.__buffer = ""
+        self.__output = ""
+        self.__serial = 0
+        self.__requests = {}
+        self.__restarts = []
+        self.__start()
+
+    def is_alive(self):
+        return self.__process != None
+
+    def get_number_of_requests(self):
+        return len(self.__requests)
+
+    # callback(result, data) gets (segments, candidates) of
+    # worker._convert() or None.
+    def convert(self, text, single, size, callback, data=None):
+        self.__request('convert', (text, single, size), callback, data)
+
+    # callback(predictions, data) gets the result of
+    # anthy_context.get_predictions() or None.
+    def predict(self, reading, callback, data=None):
+        self.__request('predict', (reading,), callback, data)
+
+    def stop(self):
+        self.__stop()
+        self.__fail_requests()
+
+    def __start(self):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # the socket is the stdin of the server as inetd does.
+            self.__process = subprocess.Popen([sys.executable, _SERVER_PATH],
+                                              stdin=child.fileno(),
+                                              close_fds=True)
+        except OSError, e:
+            print >> sys.stderr, "Cannot start the conversion server: %s" % e
+            parent.close()
+            self.__process = None
+            return
+        finally:
+            child.close()
+        parent.setblocking(False)
+        self.__socket = parent
+        self.__buffer = ""
+        self.__output = ""
+        self.__watch_id = gobject.io_add_watch(parent.fileno(),
+                                               gobject.IO_IN | \
+                                               gobject.IO_HUP | \
+                                               gobject.IO_ERR,
+                                               self.__io_cb)
+
+    def __stop(self):
+        if self.__watch_id != 0:
+            gobject.source_remove(self.__watch_id)
+            self.__watch_id = 0
+        if self.__write_id != 0:
+            gobject.source_remove(self.__write_id)
+            self.__write_id = 0
+        self.__output = ""
+        if self.__socket != None:
+            self.__socket.close()
+            self.__socket = None
+        if self.__process != None:
+            if self.__process.poll() == None:
+                try:
+                    os.kill(self.__process.pid, 9)
+                except OSError:
+                    pass
+            self.__process.wait()
+            self.__process = None
+
+    def __restart(self):
+        self.__stop()
+        self.__fail_requests()
+        now = time.time()
+        self.__restarts = [t for t in self.__restarts
+                           if now - t < CONVERSION_SERVER_RESTART_PERIOD]
+        if len(self.__restarts) >= CONVERSION_SERVER_MAX_RESTARTS:
+            print >> sys.stderr, "The conversion server is stopped."
+            return
+        self.__restarts.append(now)
+        self.__start()
+
+    def __request(self, name, args, callback, data):
+        if self.__process == None:
+            gobject.idle_add(self.__done, callback, None, data)
+            return
+        self.__serial += 1
+        timeout_id = gobject.timeout_add(self.__timeout, self.__timeout_cb,
+                                         self.__serial)
+        self.__requests[self.__serial] = (callback, data, timeout_id)
+        self.__output += _pack((self.__serial, name, args))
+        self.__flush()
+
+    # Sends the output as much as the socket accepts and the rest is
+    # sent when the socket is writable.
+    def __flush(self):
+        try:
+            n = self.__socket.send(self.__output)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                print >> sys.stderr, \
+                    "Cannot send to the conversion server: %s" % e
+                self.__restart()
+                return
+            n = 0
+        self.__output = self.__output[n:]
+        if self.__output and self.__write_id == 0:
+            self.__write_id = gobject.io_add_watch(self.__socket.fileno(),
+                                                   gobject.IO_OUT,
+                                                   self.__write_cb)
+
+    def __write_cb(self, fd, condition):
+        self.__flush()
+        if self.__output:
+            return True
+        self.__write_id = 0
+        return False
+
+    def __fail_requests(self):
+        requests = self.__requests
+        self.__requests = {}
+        for callback, data, timeout_id in requests.values():
+            gobject.source_remove(timeout_id)
+            gobject.idle_add(self.__done, callback, None, data)
+
+    def __io_cb(self, fd, condition):
+        buf = ""
+        if condition & gobject.IO_IN:
+            try:
+                buf = self.__socket.recv(65536)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return True
+                buf = ""
+        if not buf:
+            # the server crashed.
+            self.__watch_id = 0
+            self.__restart()
+            return False
+        messages, self.__buffer = _parse(self.__buffer + buf)
+        for serial, result in messages:
+            request = self.__requests.pop(serial, None)
+            # the request was timed out.
+            if request == None:
+                continue
+            callback, data, timeout_id = request
+            gobject.source_remove(timeout_id)
+            self.__done(callback, result, data)
+        return True
+
+    def __timeout_cb(self, serial):
+        request = self.__requests.pop(serial, None)
+        if request != None:
+            callback, data, timeout_id = request
+            gobject.idle_add(self.__done, callback, None, data)
+            print >> sys.stderr, "The conversion server is timed out."
+            self.__restart()
+        return False
+
+    def __done(self, callback, result, data):
+        try:
+            callback(result, data)
+        except:
+            traceback.print_exc()
+        return False
+
+
+class ConversionServerPool(object):
+    # The requests go to the server which has the fewest requests
+    # so that a long conversion does not block the other engines.
+    def __init__(self, size, timeout=CONVERSION_SERVER_TIMEOUT):
+        self.__servers = [ConversionServer(timeout) for i in xrange(size)]
+
+    def __len__(self):
+        return len(self.__servers)
+
+    def __get_server(self):
+        servers = [s for s in self.__servers if s.is_alive()]
+        if not servers:
+            return self.__servers[0]
+        return min(servers, key=lambda s: s.get_number_of_requests())
+
+    def convert(self, text, single, size, callback, data=None):
+        self.__get_server().convert(text, single, size, callback, data)
+
+    def predict(self, reading, callback, data=None):
+        self.__get_server().predict(reading, callback, data)
+
+    def stop(self):
+        for s in self.__servers:
+            s.stop()
+
+
+def serve(sock):
+    import anthy
+    import worker
+    funcs = {
+        'convert' : worker._convert,
+        'predict' : worker._predict,
+    }
+    context = anthy.anthy_context()
+    context._set_encoding(anthy.ANTHY_UTF8_ENCODING)
+    buf = ""
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            # the engine exited.
+            break
+        messages, buf = _parse(buf + data)
+        for serial, name, args in messages:
+            try:
+                result = funcs[name](context, *args)
+            except:
+                traceback.print_exc()
+                result = None
+            sock.sendall(_pack((serial, result)))
+
+if __name__ == "__main__":
+    serve(socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM))
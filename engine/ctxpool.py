@@ -0,0 +1,82 @@
+# vim:set et sts=4 sw=4:
+# -*- coding: utf-8 -*-
+#
+# ibus-anthy - The Anthy engine for IBus
+#
+# Copyright (c) 2007-2008 Peng Huang <shawn.p.huang@gmail.com>
+# Copyright (c) 2007-2011 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import gobject
+import anthy
+
+# The number of the idle contexts which are kept in a ContextPool.
+CONTEXT_POOL_SIZE = 8
+# The number of the idle contexts which are created in advance.
+CONTEXT_POOL_WARM_SIZE = 2
+
+class ContextPool(object):
+    # The anthy contexts of the destroyed engines are reset and kept
+    # for the next engines and a few contexts are created in the idle
+    # time so that an input context is created without loading anthy.
+    def __init__(self, size=CONTEXT_POOL_SIZE, warm_size=CONTEXT_POOL_WARM_SIZE):
+        self.__size = size
+        self.__warm_size = min(warm_size, size)
+        self.__contexts = []
+        self.__fill_id = 0
+        self.__schedule_fill()
+
+    def __len__(self):
+        return len(self.__contexts)
+
+    def get(self):
+        if self.__contexts:
+            context = self.__contexts.pop()
+        else:
+            context = self.__create()
+        self.__schedule_fill()
+        return context
+
+    # The context is dropped if the pool is full.
+    def put(self, context):
+        if len(self.__contexts) >= self.__size:
+            return
+        context.reset()
+        self.__contexts.append(context)
+
+    def clear(self):
+        if self.__fill_id != 0:
+            gobject.source_remove(self.__fill_id)
+            self.__fill_id = 0
+        del self.__contexts[:]
+
+    def __create(self):
+        context = anthy.anthy_context()
+        context._set_encoding(anthy.ANTHY_UTF8_ENCODING)
+        return context
+
+    def __schedule_fill(self):
+        if self.__fill_id != 0 or len(self.__contexts) >= self.__warm_size:
+            return
+        self.__fill_id = gobject.idle_add(self.__fill,
+                                          priority=gobject.PRIORITY_LOW)
+
+    def __fill(self):
+        if len(self.__contexts) >= self.__warm_size:
+            self.__fill_id = 0
+            return False
+        self.__contexts.append(self.__create())
+        return True
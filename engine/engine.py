@@ -21,6 +21,7 @@
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import os
+import re
 from os import environ, path
 from locale import getpreferredencoding
 import signal
@@ -28,14 +29,19 @@ import sys
 import gobject
 import ibus
 import anthy
-from anthy import NTH_UNCONVERTED_CANDIDATE
 from anthy import NTH_KATAKANA_CANDIDATE
 from anthy import NTH_HIRAGANA_CANDIDATE
 from anthy import NTH_HALFKANA_CANDIDATE
 from tables import *
 from ibus import keysyms
 from ibus import modifier
+import convcache
+import convserver
 import jastring
+import kana
+import prediction
+import romaji
+import worker
 from segment import unichar_half_to_full
 
 try:
@@ -78,6 +84,36 @@ SEGMENT_IMMEDIATE       = 1 << 1
 
 CLIPBOARD_RECONVERT = range(1)
 
+# The modes and the labels of the menus for the radio properties.
+INPUT_MODE_PROPS = {
+    u"InputMode.Hiragana" : (INPUT_MODE_HIRAGANA, u"あ"),
+    u"InputMode.Katakana" : (INPUT_MODE_KATAKANA, u"ア"),
+    u"InputMode.HalfWidthKatakana" : (INPUT_MODE_HALF_WIDTH_KATAKANA, u"_ｱ"),
+    u"InputMode.Latin" : (INPUT_MODE_LATIN, u"_A"),
+    u"InputMode.WideLatin" : (INPUT_MODE_WIDE_LATIN, u"Ａ"),
+}
+
+TYPING_MODE_PROPS = {
+    u"TypingMode.Romaji" : (jastring.TYPING_MODE_ROMAJI, u"R"),
+    u"TypingMode.Kana" : (jastring.TYPING_MODE_KANA, u"か"),
+    u"TypingMode.ThumbShift" : (jastring.TYPING_MODE_THUMB_SHIFT, u"親"),
+}
+
+SEGMENT_MODE_PROPS = {
+    u"SegmentMode.Multi" : (SEGMENT_DEFAULT, u"連"),
+    u"SegmentMode.Single" : (SEGMENT_SINGLE, u"単"),
+    u"SegmentMode.ImmediateMulti" : (SEGMENT_IMMEDIATE, u"逐|連"),
+    u"SegmentMode.ImmediateSingle" :
+        (SEGMENT_IMMEDIATE | SEGMENT_SINGLE, u"逐|単"),
+}
+
+# Returns (prop_name, label) of the mode.
+def get_mode_prop(mode_props, mode):
+    for prop_name, (m, label) in mode_props.items():
+        if m == mode:
+            return prop_name, label
+    return None, None
+
 LINK_DICT_EMBEDDED, \
 LINK_DICT_SINGLE = range(2)
 
@@ -85,6 +121,9 @@ IMPORTED_EMBEDDED_DICT_DIR = "imported_words_default.d"
 IMPORTED_EMBEDDED_DICT_PREFIX = "ibus__"
 IMPORTED_SINGLE_DICT_PREFIX = "imported_words_ibus__"
 
+# The statistics of the caches are printed if IBUS_ANTHY_DEBUG is set.
+DEBUG = environ.get('IBUS_ANTHY_DEBUG') != None
+
 KP_Table = {}
 for s in dir(keysyms):
     if s.startswith('KP_'):
@@ -97,6 +136,23 @@ for k, v in zip(['KP_Add', 'KP_Decimal', 'KP_Divide', 'KP_Enter', 'KP_Equal',
                  'asterisk', 'comma', 'space', 'minus']):
     KP_Table[keysyms.__getattribute__(k)] = keysyms.__getattribute__(v)
 
+# The rules are replaced with one regular expression scan.
+class RuleReplacer(object):
+    def __init__(self, rule):
+        keys = sorted(rule.keys(), key=len, reverse=True)
+        self.__rule = rule
+        self.__expression = re.compile(u"|".join(map(re.escape, keys)),
+                                       re.UNICODE)
+
+    def replace(self, text):
+        return self.__expression.sub(self.__replace_match, text)
+
+    def __replace_match(self, matched):
+        return self.__rule[matched.group(0)][0]
+
+romaji_utf8_replacer = RuleReplacer(romaji_utf8_rule)
+romaji_normalize_replacer = RuleReplacer(romaji_normalize_rule)
+
 class Engine(ibus.EngineBase):
     __typing_mode = jastring.TYPING_MODE_ROMAJI
 
@@ -104,27 +160,59 @@ class Engine(ibus.EngineBase):
     __prefs = None
     __keybind = {}
     __thumb = None
-
-    def __init__(self, bus, object_path):
+    __conversion_cache = convcache.ConversionCache()
+    __worker = None
+    __servers = None
+    # The properties are shared by the engines and rebuilt when
+    # the config is changed.  They show the modes of the focused engine.
+    __prop_list = None
+    __prop_dict = {}
+    __prop_generation = 0
+    __prop_list_generation = -1
+    __focused_engine = None
+    # The dictionary files are linked for all the engines and removed
+    # when the factory is destroyed.
+    __dict_files_linked = False
+
+    def __init__(self, bus, object_path, context_pool=None):
         super(Engine, self).__init__(bus, object_path)
 
         # create anthy context
-        self.__context = anthy.anthy_context()
-        self.__context._set_encoding(anthy.ANTHY_UTF8_ENCODING)
+        self.__context_pool = context_pool
+        if context_pool != None:
+            self.__context = context_pool.get()
+        else:
+            self.__context = anthy.anthy_context()
+            self.__context._set_encoding(anthy.ANTHY_UTF8_ENCODING)
+        self.__prediction = prediction.PredictionSession(self.__context)
 
         # init state
         self.__idle_id = 0
+        self.__speculative_id = 0
+        self.__prediction_id = 0
+        self.__prediction_visible = False
+        self.__prefetch_id = 0
+        self.__worker_serial = 0
+        self.__worker_key = None
+        self.__worker_begin_key = None
+        self.__context_single = False
+        # (text, single, dict_mode) of the string which is converted in
+        # the context and not changed since, or None.
+        self.__context_string = None
+        self.__hibernate_id = 0
+        self.__hibernated = False
         self.__input_mode = INPUT_MODE_HIRAGANA
         self.__segment_mode = SEGMENT_DEFAULT
         self.__dict_mode = 0
-        self.__prop_dict = {}
         self.__is_utf8 = (getpreferredencoding().lower() == "utf-8")
         self.__ibus_version = 0
 
 #        self.__lookup_table = ibus.LookupTable(page_size=9, round=True)
         size = self.__prefs.get_value('common', 'page_size')
         self.__lookup_table = ibus.LookupTable(page_size=size, round=True)
-        self.__prop_list = self.__init_props()
+        self.__clean_lookup_table()
+        self.__link_dict_files()
+        self.__get_prop_list()
 
         mode = self.__prefs.get_value('common', 'input_mode')
         mode = 'InputMode.' + ['Hiragana', 'Katakana', 'HalfWidthKatakana',
@@ -166,8 +254,21 @@ class Engine(ibus.EngineBase):
         self.__cursor_pos = 0
         self.__convert_mode = CONV_MODE_OFF
         self.__segments = list()
-        self.__lookup_table.clean()
+        self.__segment_readings = list()
+        self.__snapshot = None
+        self.__candidates = {}
+        self.__context_text = None
+        self.__segment_offset = 0
+        self.__clean_lookup_table()
         self.__lookup_table_visible = False
+        self.__cancel_speculative_conversion()
+        self.__cancel_prediction()
+        self.__prediction_visible = False
+        self.__cancel_prefetch()
+        # the results of the worker are out of date.
+        self.__worker_serial += 1
+        self.__worker_key = None
+        self.__worker_begin_key = None
         self._MM = 0
         self._SS = 0
         self._H = 0
@@ -204,8 +305,6 @@ class Engine(ibus.EngineBase):
                                    type=ibus.PROP_TYPE_RADIO,
                                    label=UN(_("Wide Latin"))))
 
-        props[self.__input_mode].set_state(ibus.PROP_STATE_CHECKED)
-
         for prop in props:
             self.__prop_dict[prop.key] = prop
 
@@ -229,7 +328,6 @@ class Engine(ibus.EngineBase):
         props.append(ibus.Property(key=u"TypingMode.ThumbShift",
                                    type=ibus.PROP_TYPE_RADIO,
                                    label=UN(_("Thumb shift"))))
-        props[Engine.__typing_mode].set_state(ibus.PROP_STATE_CHECKED)
 
         for prop in props:
             self.__prop_dict[prop.key] = prop
@@ -247,6 +345,63 @@ class Engine(ibus.EngineBase):
 
         return anthy_props
 
+    def __get_prop_list(self):
+        if Engine.__prop_list_generation != Engine.__prop_generation:
+            Engine.__prop_dict = {}
+            Engine.__prop_list = self.__init_props()
+            Engine.__prop_list_generation = Engine.__prop_generation
+        return Engine.__prop_list
+
+    # The shared properties get the states and the labels of
+    # this engine when it gets the focus.
+    def __sync_props(self):
+        self.__set_menu_prop(u"InputMode",
+                             *get_mode_prop(INPUT_MODE_PROPS,
+                                            self.__input_mode))
+        self.__set_menu_prop(u"TypingMode",
+                             *get_mode_prop(TYPING_MODE_PROPS,
+                                            Engine.__typing_mode))
+        self.__set_menu_prop(u"SegmentMode",
+                             *get_mode_prop(SEGMENT_MODE_PROPS,
+                                            self.__segment_mode))
+        # __dict_mode is the index of 'dict/files' as in
+        # __dict_mode_activate().
+        id = None
+        if self.__dict_mode == 0:
+            id = 'embedded'
+        else:
+            files = self.__prefs.get_value('dict', 'files')
+            if self.__dict_mode <= len(files):
+                id = self._get_dict_id_from_file(files[self.__dict_mode - 1])
+        if id != None:
+            self.__set_menu_prop(u"DictMode", UN("DictMode." + id),
+                                 self.__prefs.get_value('dict/file/' + id,
+                                                        'short_label'))
+
+    def __set_menu_prop(self, menu_name, prop_name, label):
+        prefix = menu_name + u"."
+        for name, prop in self.__prop_dict.items():
+            if not name.startswith(prefix):
+                continue
+            if name == prop_name:
+                prop.set_state(ibus.PROP_STATE_CHECKED)
+            else:
+                prop.set_state(ibus.PROP_STATE_UNCHECKED)
+        if label != None:
+            self.__prop_dict[menu_name].label = label
+
+    # The engines which are not focused do not change the shared
+    # properties.
+    def __update_prop(self, prop_name, state=None, label=None):
+        if Engine.__focused_engine != self:
+            return
+        prop = self.__prop_dict[prop_name]
+        if state != None:
+            prop.set_state(state)
+        if label != None:
+            prop.label = label
+        self.update_property(prop)
+
     def __init_signal(self):
         signal.signal(signal.SIGHUP, self.__signal_cb)
         signal.signal(signal.SIGINT, self.__signal_cb)
@@ -255,7 +410,7 @@ class Engine(ibus.EngineBase):
         signal.signal(signal.SIGTERM, self.__signal_cb)
 
     def __signal_cb(self, signum, object):
-        self.__remove_dict_files()
+        self.REMOVE_DICT_FILES()
         signal.signal(signum, signal.SIG_DFL)
         os.kill(os.getpid(), signum)
 
@@ -279,7 +434,6 @@ class Engine(ibus.EngineBase):
         props.append(ibus.Property(key=u"SegmentMode.ImmediateSingle",
                                    type=ibus.PROP_TYPE_RADIO,
                                    label=UN(_("Immediate conversion (Single segment)"))))
-        props[self.__segment_mode].set_state(ibus.PROP_STATE_CHECKED)
 
         for prop in props:
             self.__prop_dict[prop.key] = prop
@@ -304,7 +458,6 @@ class Engine(ibus.EngineBase):
                                    label=UN(_(long_label))))
 
         for file in self.__prefs.get_value('dict', 'files'):
-            self._link_dict_file(file)
             id = self._get_dict_id_from_file(file)
             if id == None:
                 continue
@@ -322,7 +475,6 @@ class Engine(ibus.EngineBase):
                                        type=ibus.PROP_TYPE_RADIO,
                                        label=uni_long_label))
 
-        props[self.__dict_mode].set_state(ibus.PROP_STATE_CHECKED)
         for prop in props:
             self.__prop_dict[prop.key] = prop
         dict_mode_prop.set_sub_props(props)
@@ -384,9 +536,12 @@ class Engine(ibus.EngineBase):
                 single_files.append(file)
         return single_files
 
-    def __remove_dict_files(self):
+    def __link_dict_files(self):
+        if Engine.__dict_files_linked:
+            return
         for file in self.__prefs.get_value('dict', 'files'):
-            self._remove_dict_file(file)
+            self._link_dict_file(file)
+        Engine.__dict_files_linked = True
 
     def update_preedit(self, string, attrs, cursor_pos, visible):
         mode = self.__prefs.get_value('common', 'behavior_on_focus_out')
@@ -406,6 +561,10 @@ class Engine(ibus.EngineBase):
         if self.__convert_mode != CONV_MODE_ANTHY:
             return False
 
+        # the first page goes round to the last page.
+        if self.__lookup_table.get_cursor_pos() < \
+           self.__lookup_table.get_page_size():
+            self.__load_lookup_table()
         if not self.__lookup_table.page_up():
             return False
 
@@ -420,6 +579,7 @@ class Engine(ibus.EngineBase):
         if self.__convert_mode != CONV_MODE_ANTHY:
             return False
 
+        self.__load_lookup_table_page(2)
         if not self.__lookup_table.page_down():
             return False
 
@@ -435,6 +595,8 @@ class Engine(ibus.EngineBase):
         if self.__convert_mode != CONV_MODE_ANTHY and self.__convert_mode != CONV_MODE_PREDICTION:
             return False
 
+        if self.__lookup_table.get_cursor_pos() == 0:
+            self.__load_lookup_table()
         if not self.__lookup_table.cursor_up():
             return False
 
@@ -450,6 +612,7 @@ class Engine(ibus.EngineBase):
         if self.__convert_mode != CONV_MODE_ANTHY and self.__convert_mode != CONV_MODE_PREDICTION:
             return False
 
+        self.__load_lookup_table_page(2)
         if not self.__lookup_table.cursor_down():
             return False
 
@@ -472,14 +635,19 @@ class Engine(ibus.EngineBase):
         self.__invalidate()
 
     def __shrink_segment(self, relative_size):
-        self.__context.resize_segment(self.__cursor_pos, relative_size)
-        conv_stat = anthy.anthy_conv_stat()
-        self.__context.get_stat(conv_stat)
-        del self.__segments[self.__cursor_pos:]
-        for i in xrange(self.__cursor_pos, conv_stat.nr_segment):
-            buf = self.__context.get_segment(i, 0)
-            text = unicode(buf, "utf-8")
-            self.__segments.append((0, text))
+        self.__sync_context()
+        if self.__snapshot != None:
+            self.__candidates = self.__snapshot.copy_candidates()
+            self.__snapshot = None
+        pos = self.__get_context_pos()
+        self.__context_string = None
+        self.__context.resize_segment(pos, relative_size)
+        # anthy may order the candidates differently after a resize so
+        # the candidates of the segments from pos are loaded again.
+        for key in self.__candidates.keys():
+            if key[0] >= pos:
+                del self.__candidates[key]
+        self.__set_segments(self.__context.get_segments(pos), self.__cursor_pos)
         self.__lookup_table_visible = False
         self.__fill_lookup_table()
         self.__invalidate()
@@ -488,6 +656,7 @@ class Engine(ibus.EngineBase):
     if ibus.get_version() >= '1.2.0':
         def process_key_event(self, keyval, keycode, state):
             try:
+                self.__wake_up()
                 return self.process_key_event_internal2(keyval, keycode, state)
             except:
                 import traceback
@@ -496,6 +665,7 @@ class Engine(ibus.EngineBase):
     else:
         def process_key_event(self, keyval, state):
             try:
+                self.__wake_up()
                 return self.process_key_event_internal2(keyval, 0, state)
             except:
                 import traceback
@@ -572,6 +742,7 @@ class Engine(ibus.EngineBase):
             return False'''
 
     def property_activate(self, prop_name, state):
+        self.__wake_up()
 
         if state == ibus.PROP_STATE_CHECKED:
             if prop_name == None:
@@ -596,7 +767,8 @@ class Engine(ibus.EngineBase):
             elif prop_name == 'setup-dict-kasumi-word':
                 self.__start_add_word()
             else:
-                self.__prop_dict[prop_name].set_state(state)
+                if Engine.__focused_engine == self:
+                    self.__prop_dict[prop_name].set_state(state)
                 if prop_name == "DictMode":
                     sub_name = self.__dict_mode_get_prop_name(self.__dict_mode)
                     if sub_name == None:
@@ -605,94 +777,54 @@ class Engine(ibus.EngineBase):
                                               ibus.PROP_STATE_CHECKED)
 
     def __input_mode_activate(self, prop_name, state):
-        input_modes = {
-            u"InputMode.Hiragana" : (INPUT_MODE_HIRAGANA, u"あ"),
-            u"InputMode.Katakana" : (INPUT_MODE_KATAKANA, u"ア"),
-            u"InputMode.HalfWidthKatakana" : (INPUT_MODE_HALF_WIDTH_KATAKANA, u"_ｱ"),
-            u"InputMode.Latin" : (INPUT_MODE_LATIN, u"_A"),
-            u"InputMode.WideLatin" : (INPUT_MODE_WIDE_LATIN, u"Ａ"),
-        }
-
-        if prop_name not in input_modes:
+        if prop_name not in INPUT_MODE_PROPS:
             print >> sys.stderr, "Unknow prop_name = %s" % prop_name
             return
-        self.__prop_dict[prop_name].set_state(state)
-        self.update_property(self.__prop_dict[prop_name])
+        self.__update_prop(prop_name, state)
 
-        mode, label = input_modes[prop_name]
+        mode, label = INPUT_MODE_PROPS[prop_name]
         if self.__input_mode == mode:
             return
 
         self.__input_mode = mode
-        prop = self.__prop_dict[u"InputMode"]
-        prop.label = label
-        self.update_property(prop)
+        self.__update_prop(u"InputMode", label=label)
 
         self.__reset()
         self.__invalidate()
 
     def __typing_mode_activate(self, prop_name, state):
-        typing_modes = {
-            u"TypingMode.Romaji" : (jastring.TYPING_MODE_ROMAJI, u"R"),
-            u"TypingMode.Kana" : (jastring.TYPING_MODE_KANA, u"か"),
-            u"TypingMode.ThumbShift" : (jastring.TYPING_MODE_THUMB_SHIFT, u"親"),
-        }
-
-        if prop_name not in typing_modes:
+        if prop_name not in TYPING_MODE_PROPS:
             print >> sys.stderr, "Unknow prop_name = %s" % prop_name
             return
-        self.__prop_dict[prop_name].set_state(state)
-        self.update_property(self.__prop_dict[prop_name])
+        self.__update_prop(prop_name, state)
         if prop_name == u"TypingMode.ThumbShift":
             self._reset_thumb()
 
-        mode, label = typing_modes[prop_name]
+        mode, label = TYPING_MODE_PROPS[prop_name]
 
         Engine.__typing_mode = mode
-        prop = self.__prop_dict[u"TypingMode"]
-        prop.label = label
-        self.update_property(prop)
+        self.__update_prop(u"TypingMode", label=label)
 
         self.__reset()
         self.__invalidate()
 
     def __refresh_typing_mode_property(self):
-        prop = self.__prop_dict[u"TypingMode"]
-        modes = {
-            jastring.TYPING_MODE_ROMAJI : (u"TypingMode.Romaji", u"R"),
-            jastring.TYPING_MODE_KANA : (u"TypingMode.Kana", u"か"),
-            jastring.TYPING_MODE_THUMB_SHIFT : (u"TypingMode.ThumbShift", u"親"),
-        }
-        prop_name, label = modes.get(Engine.__typing_mode, (None, None))
+        prop_name, label = get_mode_prop(TYPING_MODE_PROPS, Engine.__typing_mode)
         if prop_name == None or label == None:
             return
-        _prop = self.__prop_dict[prop_name]
-        _prop.set_state(ibus.PROP_STATE_CHECKED)
-        self.update_property(_prop)
-        prop.label = label
-        self.update_property(prop)
+        self.__update_prop(prop_name, ibus.PROP_STATE_CHECKED)
+        self.__update_prop(u"TypingMode", label=label)
 
     def __segment_mode_activate(self, prop_name, state):
-        segment_modes = {
-            u"SegmentMode.Multi" : (SEGMENT_DEFAULT, u"連"),
-            u"SegmentMode.Single" : (SEGMENT_SINGLE, u"単"),
-            u"SegmentMode.ImmediateMulti" : (SEGMENT_IMMEDIATE, u"逐|連"),
-            u"SegmentMode.ImmediateSingle" :
-                (SEGMENT_IMMEDIATE | SEGMENT_SINGLE, u"逐|単"),
-        }
-
-        if prop_name not in segment_modes:
+        if prop_name not in SEGMENT_MODE_PROPS:
             print >> sys.stderr, "Unknow prop_name = %s" % prop_name
             return
-        self.__prop_dict[prop_name].set_state(state)
-        self.update_property(self.__prop_dict[prop_name])
+        self.__update_prop(prop_name, state)
 
-        mode, label = segment_modes[prop_name]
+        mode, label = SEGMENT_MODE_PROPS[prop_name]
 
         self.__segment_mode = mode
-        prop = self.__prop_dict[u"SegmentMode"]
-        prop.label = label
-        self.update_property(prop)
+        self.__update_prop(u"SegmentMode", label=label)
 
         self.__reset()
         self.__invalidate()
@@ -739,18 +871,22 @@ class Engine(ibus.EngineBase):
         else:
             dict_name = 'ibus__' + id
             self.__dict_mode = files.index(file) + 1
-        self.__prop_dict[prop_name].set_state(state)
-        self.update_property(self.__prop_dict[prop_name])
+        self.__update_prop(prop_name, state)
         self.__context.init_personality()
         self.__context.do_set_personality(dict_name)
+        self.__prediction.clear()
 
-        prop = self.__prop_dict[u"DictMode"]
         section = 'dict/file/' + id
-        prop.label = self.__prefs.get_value(section, 'short_label')
-        self.update_property(prop)
+        self.__update_prop(u"DictMode",
+                           label=self.__prefs.get_value(section, 'short_label'))
 
     def focus_in(self):
-        self.register_properties(self.__prop_list)
+        self.__cancel_hibernation()
+        self.__wake_up()
+        Engine.__focused_engine = self
+        prop_list = self.__get_prop_list()
+        self.__sync_props()
+        self.register_properties(prop_list)
         self.__refresh_typing_mode_property()
         mode = self.__prefs.get_value('common', 'behavior_on_focus_out')
         if mode == 2:
@@ -760,12 +896,73 @@ class Engine(ibus.EngineBase):
         size = self.__prefs.get_value('common', 'page_size')
         if size != self.__lookup_table.get_page_size():
             self.__lookup_table.set_page_size(size)
+            if self.__convert_mode == CONV_MODE_ANTHY:
+                self.__load_lookup_table_page(1)
 
     def focus_out(self):
+        if Engine.__focused_engine == self:
+            Engine.__focused_engine = None
         mode = self.__prefs.get_value('common', 'behavior_on_focus_out')
         if mode == 0 or mode == 1:
             self.__reset()
             self.__invalidate()
+        self.__schedule_hibernation()
+
+    # The engines which are not focused for a while release the anthy
+    # context and the caches, and they are restored when the engine
+    # gets the focus or a key event again.
+    def __schedule_hibernation(self):
+        self.__cancel_hibernation()
+        delay = self.__prefs.get_value('common', 'hibernate_delay')
+        if delay <= 0 or self.__hibernated:
+            return
+        self.__hibernate_id = gobject.timeout_add(delay * 1000,
+                                                  self.__hibernate)
+
+    def __cancel_hibernation(self):
+        if self.__hibernate_id != 0:
+            gobject.source_remove(self.__hibernate_id)
+            self.__hibernate_id = 0
+
+    def __hibernate(self):
+        self.__hibernate_id = 0
+        # the preedit is kept by behavior_on_focus_out and the context
+        # of the other personality cannot be restored from the pool.
+        if self.__convert_mode != CONV_MODE_OFF or \
+           not self.__preedit_ja_string.is_empty() or \
+           self.__dict_mode != 0:
+            return False
+        self.__cancel_speculative_conversion()
+        self.__cancel_prediction()
+        self.__cancel_prefetch()
+        self.__worker_serial += 1
+        self.__worker_key = None
+        self.__worker_begin_key = None
+        self.__hibernated = True
+        if self.__context_pool != None:
+            self.__context_pool.put(self.__context)
+        self.__context = None
+        self.__prediction = None
+        self.__snapshot = None
+        self.__candidates = {}
+        # the context from the pool does not hold the string.
+        self.__context_text = None
+        self.__context_string = None
+        self.__clean_lookup_table()
+        self.__lookup_table_visible = False
+        self.__prediction_visible = False
+        return False
+
+    def __wake_up(self):
+        if not self.__hibernated:
+            return
+        if self.__context_pool != None:
+            self.__context = self.__context_pool.get()
+        else:
+            self.__context = anthy.anthy_context()
+            self.__context._set_encoding(anthy.ANTHY_UTF8_ENCODING)
+        self.__prediction = prediction.PredictionSession(self.__context)
+        self.__hibernated = False
 
     def disable(self):
         self.__reset()
@@ -779,28 +976,23 @@ class Engine(ibus.EngineBase):
         if self.__idle_id != 0:
             gobject.source_remove(self.__idle_id)
             self.__idle_id = 0
-        self.__remove_dict_files()
+        self.__cancel_speculative_conversion()
+        self.__cancel_prediction()
+        self.__cancel_prefetch()
+        self.__cancel_hibernation()
+        self.__worker_serial += 1
+        if Engine.__focused_engine == self:
+            Engine.__focused_engine = None
+        # the context of the other personality is not reused.
+        if self.__context_pool != None and self.__context != None and \
+           self.__dict_mode == 0:
+            self.__context_pool.put(self.__context)
         super(Engine,self).do_destroy()
 
-    def __join_all_segments(self):
-        while True:
-            conv_stat = anthy.anthy_conv_stat()
-            self.__context.get_stat(conv_stat)
-            seg = conv_stat.nr_segment - self.__cursor_pos
-
-            if seg > 1:
-                self.__context.resize_segment(self.__cursor_pos, 1)
-            else:
-                break
-
     def __normalize_preedit(self, preedit):
         if not self.__is_utf8:
             return preedit
-        for key in romaji_normalize_rule.keys():
-            if preedit.find(key) >= 0:
-                for value in romaji_normalize_rule[key]:
-                    preedit = preedit.replace(key, value)
-        return preedit
+        return romaji_normalize_replacer.replace(preedit)
 
     # begine convert
     def __begin_anthy_convert(self):
@@ -814,24 +1006,284 @@ class Engine(ibus.EngineBase):
         text, cursor = self.__preedit_ja_string.get_hiragana(True)
 
         text = self.__normalize_preedit(text)
-        self.__context.set_string(text.encode("utf8"))
-        if self.__segment_mode & SEGMENT_SINGLE:
-            self.__join_all_segments()
-        conv_stat = anthy.anthy_conv_stat()
-        self.__context.get_stat(conv_stat)
-
-        for i in xrange(0, conv_stat.nr_segment):
-            buf = self.__context.get_segment(i, 0)
-            text = unicode(buf, "utf-8")
-            self.__segments.append((0, text))
+        key = (text, self.__segment_mode, self.__dict_mode)
+        snapshot = self.__get_conversion_cache(key)
+        if snapshot == None:
+            snapshot = self.__convert_context(key)
+            self.__context_text = None
+        else:
+            # the context is converted when it is needed.
+            self.__context_text = text
+            self.__context_single = \
+                (self.__segment_mode & SEGMENT_SINGLE) != 0
+        self.__snapshot = snapshot
+        self.__candidates = snapshot.candidates
+        self.__set_segments(snapshot.segments)
 
         if self.__segment_mode & SEGMENT_IMMEDIATE:
-            self.__cursor_pos = conv_stat.nr_segment - 1
+            self.__cursor_pos = len(self.__segments) - 1
         else:
             self.__cursor_pos = 0
         self.__fill_lookup_table()
         self.__lookup_table_visible = False
 
+    def __convert_context(self, key):
+        text, segment_mode, dict_mode = key
+        if segment_mode & SEGMENT_SINGLE:
+            segments = self.__context.set_string_single(text.encode("utf8"))
+        else:
+            segments = self.__context.set_string_segments(text.encode("utf8"))
+        self.__context_string = (text, (segment_mode & SEGMENT_SINGLE) != 0,
+                                 dict_mode)
+        snapshot = convcache.ConversionSnapshot(segments)
+        self.__add_conversion_cache(key, snapshot)
+        return snapshot
+
+    # The conversions in the immediate mode are not cached since every
+    # key event converts a prefix of the preedit.
+    def __get_conversion_cache(self, key):
+        if key[1] & SEGMENT_IMMEDIATE:
+            return None
+        snapshot = Engine.__conversion_cache.get(key)
+        if DEBUG:
+            hits, misses, size = Engine.__conversion_cache.get_stats()
+            print 'CONVERSION_CACHE = %d hits, %d misses, %d snapshots, ' \
+                  '%.1f%%' % (hits, misses, size,
+                              Engine.__conversion_cache.get_hit_rate() * 100)
+        return snapshot
+
+    def __add_conversion_cache(self, key, snapshot):
+        if key[1] & SEGMENT_IMMEDIATE:
+            return
+        Engine.__conversion_cache.add(key, snapshot)
+
+    # convert the preedit after the user stops typing so that
+    # __begin_anthy_convert finds it in the conversion cache.
+    def __schedule_speculative_conversion(self):
+        self.__cancel_speculative_conversion()
+        if self.__convert_mode != CONV_MODE_OFF or \
+           self.__preedit_ja_string.is_empty():
+            return
+        # the result is not cached in the immediate mode.
+        if self.__segment_mode & SEGMENT_IMMEDIATE:
+            return
+        if not self.__prefs.get_value('common', 'speculative_conversion'):
+            return
+        delay = self.__prefs.get_value('common', 'speculative_conversion_delay')
+        self.__speculative_id = gobject.timeout_add(delay,
+                                                    self.__speculative_convert)
+
+    def __cancel_speculative_conversion(self):
+        if self.__speculative_id != 0:
+            gobject.source_remove(self.__speculative_id)
+            self.__speculative_id = 0
+
+    def __speculative_convert(self):
+        self.__speculative_id = 0
+        if self.__convert_mode != CONV_MODE_OFF or \
+           self.__preedit_ja_string.is_empty() or \
+           self.__segment_mode & SEGMENT_IMMEDIATE:
+            return False
+        key = self.__get_conversion_key()
+        if key in Engine.__conversion_cache:
+            return False
+        if not self.__convert_in_worker(key, False):
+            self.__convert_context(key)
+        return False
+
+    def __get_conversion_key(self):
+        text, cursor = self.__preedit_ja_string.get_hiragana(True)
+        text = self.__normalize_preedit(text)
+        return (text, self.__segment_mode, self.__dict_mode)
+
+    # The worker and the servers are used for the default personality
+    # only since they have their own anthy contexts.
+    def __get_worker(self):
+        if self.__dict_mode != 0:
+            return None
+        if Engine.__servers != None:
+            return Engine.__servers
+        if not self.__prefs.get_value('common', 'conversion_worker'):
+            return None
+        if Engine.__worker == None:
+            # the worker thread runs while the main loop waits.
+            gobject.threads_init()
+            Engine.__worker = worker.ConversionWorker()
+        return Engine.__worker
+
+    # convert the key in the worker and begin the conversion
+    # when the result comes back if begin is True.
+    def __convert_in_worker(self, key, begin):
+        conversion_worker = self.__get_worker()
+        # the result is not cached in the immediate mode.
+        if conversion_worker == None or key[1] & SEGMENT_IMMEDIATE:
+            return False
+        if begin:
+            self.__worker_begin_key = key
+        if self.__worker_key != key:
+            self.__worker_key = key
+            text, segment_mode, dict_mode = key
+            conversion_worker.convert(text,
+                                      (segment_mode & SEGMENT_SINGLE) != 0,
+                                      self.__lookup_table.get_page_size(),
+                                      self.__worker_converted,
+                                      (self.__worker_serial, key))
+        return True
+
+    # result is (segments, candidates) and the snapshot has the first
+    # page of every segment so that showing it does not convert
+    # the context in the main loop.
+    def __worker_converted(self, result, data):
+        serial, key = data
+        if serial != self.__worker_serial:
+            return
+        if self.__worker_key == key:
+            self.__worker_key = None
+        if result != None:
+            self.__add_conversion_cache(key,
+                                        convcache.ConversionSnapshot(*result))
+        if self.__worker_begin_key != key:
+            return
+        self.__worker_begin_key = None
+        # the preedit was changed while the worker converted it.
+        if self.__convert_mode != CONV_MODE_OFF or \
+           self.__get_conversion_key() != key:
+            return
+        # the preedit is left unconverted if the worker failed or timed
+        # out since converting it here would block the main loop.
+        if result == None:
+            return
+        self.__begin_anthy_convert()
+        self.__invalidate()
+
+    # show the predictions of the preedit after the user stops typing.
+    def __schedule_prediction(self):
+        self.__cancel_prediction()
+        if self.__convert_mode != CONV_MODE_OFF:
+            return
+        if self.__prediction_visible:
+            self.__prediction_visible = False
+            self.__lookup_table.clean()
+            self.__lookup_table_visible = False
+        if self.__preedit_ja_string.is_empty():
+            return
+        if not self.__prefs.get_value('common', 'prediction_as_you_type'):
+            return
+        delay = self.__prefs.get_value('common', 'prediction_delay')
+        self.__prediction_id = gobject.timeout_add(delay,
+                                                   self.__predict_as_you_type)
+
+    def __cancel_prediction(self):
+        if self.__prediction_id != 0:
+            gobject.source_remove(self.__prediction_id)
+            self.__prediction_id = 0
+
+    def __predict_as_you_type(self):
+        self.__prediction_id = 0
+        if self.__convert_mode != CONV_MODE_OFF or \
+           self.__preedit_ja_string.is_empty():
+            return False
+        text, cursor = self.__preedit_ja_string.get_hiragana(True)
+        predictions = self.__prediction.find_predictions(text)
+        if predictions == None:
+            conversion_worker = self.__get_worker()
+            if conversion_worker != None:
+                conversion_worker.predict(text, self.__worker_predicted,
+                                          (self.__worker_serial, text))
+                return False
+            predictions = self.__prediction.get_predictions(text)
+        self.__show_predictions(predictions)
+        return False
+
+    def __worker_predicted(self, predictions, data):
+        serial, text = data
+        if serial != self.__worker_serial or predictions == None:
+            return
+        self.__prediction.add_predictions(text, predictions)
+        # the preedit was changed while the worker predicted it.
+        if self.__convert_mode != CONV_MODE_OFF or \
+           self.__preedit_ja_string.get_hiragana(True)[0] != text:
+            return
+        self.__show_predictions(predictions)
+
+    def __show_predictions(self, predictions):
+        if not predictions:
+            return
+        self.__lookup_table.clean()
+        for buf in predictions[:self.__lookup_table.get_page_size()]:
+            self.__lookup_table.append_candidate(ibus.Text(unicode(buf,
+                                                                   "utf-8")))
+        self.__prediction_visible = True
+        self.__lookup_table_visible = True
+        self.update_lookup_table(self.__lookup_table, True)
+
+    # segments are the tuples of (candidate, reading, nr_candidate)
+    # from the anthy context.
+    # Every segment from start shows its first candidate, and
+    # the candidates of a segment are loaded again unless they are
+    # already in __candidates.
+    def __set_segments(self, segments, start=0):
+        del self.__segments[start:]
+        del self.__segment_readings[start:]
+        for i, (candidate, reading, nr_candidate) in enumerate(segments):
+            reading = unicode(reading, "utf-8")
+            key = (start + i + self.__segment_offset, reading)
+            self.__candidates.setdefault(key, (nr_candidate, [candidate]))
+            self.__segments.append((0, unicode(candidate, "utf-8")))
+            self.__segment_readings.append(reading)
+
+    # convert the context if the segments are restored from
+    # the conversion cache.  Returns True if the context segments
+    # the text differently and the segments are loaded again from it.
+    def __sync_context(self):
+        if self.__context_text == None:
+            return False
+        string = (self.__context_text, self.__context_single, self.__dict_mode)
+        self.__context_text = None
+        if string == self.__context_string:
+            # the context was converted while the user was typing.
+            segments = self.__context.get_segments(0)
+        elif self.__context_single:
+            segments = self.__context.set_string_single(string[0].encode("utf8"))
+        else:
+            segments = self.__context.set_string_segments(string[0].encode("utf8"))
+        self.__context_string = string
+        # the snapshot may be converted by a conversion server whose
+        # personality and learning are not the same as the context.
+        readings = [unicode(reading, "utf-8")
+                    for candidate, reading, nr_candidate in segments]
+        if readings == self.__segment_readings:
+            return False
+        Engine.__conversion_cache.remove((string[0], self.__segment_mode,
+                                          self.__dict_mode))
+        self.__snapshot = None
+        self.__candidates = {}
+        self.__set_segments(segments)
+        self.__cursor_pos = min(self.__cursor_pos, len(self.__segments) - 1)
+        return True
+
+    # the learning of the committed segments changes the next conversions.
+    def __learn_segments(self):
+        self.__sync_context()
+        self.__context_string = None
+        for i, (seg_index, text) in enumerate(self.__segments):
+            self.__context.commit_segment(i + self.__segment_offset, seg_index)
+        self.__clear_learned_caches()
+
+    # The conversions and the predictions are out of date after
+    # anthy learns the committed segments.
+    def __clear_learned_caches(self):
+        Engine.__conversion_cache.clear()
+        self.__prediction.clear()
+
+    # the committed segments are kept in the context so the segment
+    # in the context is shifted by __segment_offset.
+    def __get_context_pos(self):
+        return self.__cursor_pos + self.__segment_offset
+
+    def __get_readings_length(self, start, end):
+        return sum(map(len, self.__segment_readings[start:end]))
+
     def __end_anthy_convert(self):
         if self.__convert_mode == CONV_MODE_OFF:
             return
@@ -839,8 +1291,14 @@ class Engine(ibus.EngineBase):
         self.__convert_mode = CONV_MODE_OFF
         self.__convert_chars = u""
         self.__segments = list()
+        self.__segment_readings = list()
+        self.__snapshot = None
+        self.__candidates = {}
+        self.__context_text = None
+        self.__segment_offset = 0
+        self.__cancel_prefetch()
         self.__cursor_pos = 0
-        self.__lookup_table.clean()
+        self.__clean_lookup_table()
         self.__lookup_table_visible = False
 
     def __end_convert(self):
@@ -850,11 +1308,9 @@ class Engine(ibus.EngineBase):
     def __candidate_cb(self, candidate):
         if not self.__is_utf8:
             return
-        for key in romaji_utf8_rule.keys():
-            if candidate.find(key) >= 0:
-                for value in romaji_utf8_rule[key]:
-                    candidate = candidate.replace(key, value)
-                    self.__lookup_table.append_candidate(ibus.Text(candidate))
+        text = romaji_utf8_replacer.replace(candidate)
+        if text != candidate:
+            self.__lookup_table.append_candidate(ibus.Text(text))
 
     def __fill_anthy_zipcode_strip(self, dict_file, id):
         import re
@@ -894,34 +1350,135 @@ class Engine(ibus.EngineBase):
             self.__fill_anthy_zipcode_strip(file, id)
 
     def __fill_lookup_table(self):
+        self.__prediction_visible = False
         if self.__convert_mode == CONV_MODE_PREDICTION:
-            seg_stat = anthy.anthy_prediction_stat()
-            self.__context.get_prediction_stat(seg_stat)
+            self.__nr_candidates = len(self.__prediction.get_predictions())
+        elif self.__cursor_pos < len(self.__segment_readings):
+            self.__nr_candidates = self.__get_candidates(self.__cursor_pos)[0]
+            self.__schedule_prefetch()
+        else:
+            self.__nr_candidates = 0
 
-            # fill lookup_table
-            self.__lookup_table.clean()
-            for i in xrange(0, seg_stat.nr_prediction):
-                buf = self.__context.get_prediction(i)
+        # fill lookup_table with the first page only and the other
+        # candidates are loaded when the cursor moves to the pages.
+        self.__lookup_table.clean()
+        self.__nr_loaded_candidates = 0
+        self.__lookup_table_loaded = False
+        self.__load_lookup_table_page(1)
+
+    def __clean_lookup_table(self):
+        self.__lookup_table.clean()
+        self.__nr_candidates = 0
+        self.__nr_loaded_candidates = 0
+        self.__lookup_table_loaded = True
+
+    # load the candidates until the lookup table has size candidates.
+    def __load_lookup_table(self, size=-1):
+        if self.__lookup_table_loaded:
+            return
+        start = self.__nr_loaded_candidates
+        end = self.__nr_candidates
+        if size >= 0:
+            end = min(end,
+                      start + size - self.__lookup_table.get_number_of_candidates())
+        if start < end:
+            if self.__convert_mode == CONV_MODE_PREDICTION:
+                bufs = self.__prediction.get_predictions()[start:end]
+            elif self.__sync_candidates(self.__cursor_pos, end):
+                # the lookup table has the candidates of the old segment.
+                self.__fill_lookup_table()
+                return
+            else:
+                bufs = self.__get_segment_candidates(self.__cursor_pos,
+                                                     start, end)
+            for buf in bufs:
                 candidate = unicode(buf, "utf-8")
                 self.__lookup_table.append_candidate(ibus.Text(candidate))
                 self.__candidate_cb(candidate)
+            self.__nr_loaded_candidates = start + len(bufs)
+            if len(bufs) < end - start:
+                self.__nr_candidates = self.__nr_loaded_candidates
+        if self.__nr_loaded_candidates < self.__nr_candidates:
+            return
+        self.__lookup_table_loaded = True
+        if self.__convert_mode != CONV_MODE_PREDICTION:
+            self.__fill_lookup_table_dict_mode()
+
+    # Returns (nr_candidate, candidates) of the segment at pos.
+    def __get_candidates(self, pos):
+        key = (pos + self.__segment_offset, self.__segment_readings[pos])
+        entry = self.__candidates.get(key, None)
+        if entry == None:
+            if self.__sync_context():
+                return self.__get_candidates(min(pos,
+                                                 len(self.__segments) - 1))
+            seg_stat = anthy.anthy_segment_stat()
+            self.__context.get_segment_stat(key[0], seg_stat)
+            entry = (seg_stat.nr_candidate, [])
+            self.__candidates[key] = entry
+        return entry
+
+    # Converts the context if the candidates of the segment at pos until
+    # end are not loaded.  Returns True if the segments are loaded again.
+    def __sync_candidates(self, pos, end):
+        key = (pos + self.__segment_offset, self.__segment_readings[pos])
+        entry = self.__candidates.get(key, None)
+        if entry != None and len(entry[1]) >= min(end, entry[0]):
+            return False
+        return self.__sync_context()
+
+    def __get_segment_candidates(self, pos, start, end):
+        nr_candidate, candidates = self.__get_candidates(pos)
+        if len(candidates) < min(end, nr_candidate):
+            self.__sync_context()
+            candidates.extend(self.__context.get_segment_candidates(
+                pos + self.__segment_offset, len(candidates), end))
+        return candidates[start:end]
+
+    # load the first page of the segments next to the cursor in idle
+    # time so that moving to them does not wait for anthy.
+    def __schedule_prefetch(self):
+        if self.__prefetch_id != 0 or self.__convert_mode != CONV_MODE_ANTHY:
             return
+        self.__prefetch_id = gobject.idle_add(self.__prefetch_candidates,
+                                              priority = gobject.PRIORITY_LOW)
 
-        # get segment stat
-        seg_stat = anthy.anthy_segment_stat()
-        self.__context.get_segment_stat(self.__cursor_pos, seg_stat)
+    def __cancel_prefetch(self):
+        if self.__prefetch_id != 0:
+            gobject.source_remove(self.__prefetch_id)
+            self.__prefetch_id = 0
 
-        # fill lookup_table
-        self.__lookup_table.clean()
-        for i in xrange(0, seg_stat.nr_candidate):
-            buf = self.__context.get_segment(self.__cursor_pos, i)
-            candidate = unicode(buf, "utf-8")
-            self.__lookup_table.append_candidate(ibus.Text(candidate))
-            self.__candidate_cb(candidate)
-        self.__fill_lookup_table_dict_mode()
+    def __prefetch_candidates(self):
+        self.__prefetch_id = 0
+        if self.__convert_mode != CONV_MODE_ANTHY:
+            return False
+        size = self.__lookup_table.get_page_size()
+        for pos in (self.__cursor_pos + 1, self.__cursor_pos - 1):
+            if not 0 <= pos < len(self.__segments):
+                continue
+            if self.__sync_candidates(pos, size):
+                self.__fill_lookup_table()
+                self.__invalidate()
+                return False
+            self.__get_segment_candidates(pos, 0, size)
+        return False
+
+    # load the candidates until the end of the pages from the cursor.
+    def __load_lookup_table_page(self, pages):
+        page_size = self.__lookup_table.get_page_size()
+        pos = self.__lookup_table.get_cursor_pos()
+        self.__load_lookup_table((pos // page_size + pages) * page_size)
 
+    # The candidates in the lookup table include the candidates which are
+    # added by __candidate_cb() and the dict mode, and the candidates
+    # which are not loaded yet are counted by anthy.
+    def __get_number_of_candidates(self):
+        return self.__lookup_table.get_number_of_candidates() + \
+               self.__nr_candidates - self.__nr_loaded_candidates
 
     def __invalidate(self):
+        self.__schedule_speculative_conversion()
+        self.__schedule_prediction()
         if self.__idle_id != 0:
             return
         self.__idle_id = gobject.idle_add(self.__update,
@@ -1025,7 +1582,7 @@ class Engine(ibus.EngineBase):
         attrs.append(ibus.AttributeForeground(ibus.RGB(0, 0, 0),
                 pos, pos + len(self.__segments[self.__cursor_pos][1])))
         self.update_preedit(self.__convert_chars, attrs, pos, True)
-        aux_string = u"( %d / %d )" % (self.__lookup_table.get_cursor_pos() + 1, self.__lookup_table.get_number_of_candidates())
+        aux_string = u"( %d / %d )" % (self.__lookup_table.get_cursor_pos() + 1, self.__get_number_of_candidates())
         self.update_aux_string(aux_string,
             ibus.AttrList(), self.__lookup_table_visible)
         self.update_lookup_table(self.__lookup_table,
@@ -1047,11 +1604,11 @@ class Engine(ibus.EngineBase):
             text, cursor = self.__get_preedit(True)
             self.__commit_string(text)
         elif self.__convert_mode == CONV_MODE_ANTHY:
-            for i, (seg_index, text) in enumerate(self.__segments):
-                self.__context.commit_segment(i, seg_index)
+            self.__learn_segments()
             self.__commit_string(self.__convert_chars)
         elif self.__convert_mode == CONV_MODE_PREDICTION:
-            self.__context.commit_prediction(self.__segments[0][0])
+            self.__prediction.commit(self.__segments[0][0])
+            Engine.__conversion_cache.clear()
             self.__commit_string(self.__convert_chars)
         else:
             self.__commit_string(self.__convert_chars)
@@ -1103,9 +1660,7 @@ class Engine(ibus.EngineBase):
                   INPUT_MODE_KATAKANA: u"ア",
                   INPUT_MODE_HALF_WIDTH_KATAKANA: u"_ｱ" }
 
-        prop = self.__prop_dict[u"InputMode"]
-        prop.label = modes[self.__input_mode]
-        self.update_property(prop)
+        self.__update_prop(u"InputMode", label=modes[self.__input_mode])
 
         self.__invalidate()
         return True'''
@@ -1311,8 +1866,7 @@ class Engine(ibus.EngineBase):
             # Commit nothing
             pass
         elif self.__convert_mode == CONV_MODE_ANTHY:
-            for i, (seg_index, text) in enumerate(self.__segments):
-                self.__context.commit_segment(i, seg_index)
+            self.__learn_segments()
             self.__commit_string(self.__convert_chars)
         elif self.__convert_mode != CONV_MODE_OFF:
             self.__commit_string(self.__convert_chars)
@@ -1331,6 +1885,32 @@ class Engine(ibus.EngineBase):
         return True
 
 #=======================================================================
+    @classmethod
+    def START_CONVERSION_SERVERS(cls):
+        size = cls.__prefs.get_value('common', 'conversion_servers')
+        if cls.__servers != None or size <= 0:
+            return
+        timeout = cls.__prefs.get_value('common', 'conversion_server_timeout')
+        cls.__servers = convserver.ConversionServerPool(size, timeout)
+
+    @classmethod
+    def STOP_CONVERSION_SERVERS(cls):
+        if cls.__servers != None:
+            cls.__servers.stop()
+            cls.__servers = None
+
+    @classmethod
+    def STOP_WORKER(cls):
+        if cls.__worker != None:
+            cls.__worker.stop()
+            cls.__worker = None
+
+    @classmethod
+    def REMOVE_DICT_FILES(cls):
+        for file in cls.__prefs.get_value('dict', 'files'):
+            cls._remove_dict_file(file)
+        cls.__dict_files_linked = False
+
     @classmethod
     def CONFIG_RELOADED(cls, bus):
         print 'RELOADED'
@@ -1340,6 +1920,11 @@ class Engine(ibus.EngineBase):
         cls.__keybind = cls._mk_keybind()
 
         jastring.JaString._prefs = cls.__prefs
+        jastring.JaString._reset_chk_text()
+        cls.__conversion_cache.clear()
+        cls.__prop_generation += 1
+        # the dictionary files are linked again for the reloaded config.
+        cls.__dict_files_linked = False
 
     @classmethod
     def CONFIG_VALUE_CHANGED(cls, bus, section, name, value):
@@ -1369,15 +1954,31 @@ class Engine(ibus.EngineBase):
             cls.__prefs.set_value(base_sec, name, value)
             if name == 'shortcut_type':
                 cls.__keybind = cls._mk_keybind()
+            elif name in ('period_style', 'symbol_style',
+                          'half_width_symbol', 'half_width_number'):
+                jastring.JaString._reset_chk_text()
+            elif name in ('dict_admin_command', 'dict_config_icon'):
+                cls.__prop_generation += 1
         elif base_sec == 'thumb':
             cls.__prefs.set_value(base_sec, name, value)
             cls._reset_thumb()
         elif base_sec == 'dict':
             cls._set_dict_files_value(base_sec, name, value)
+            cls.__conversion_cache.clear()
+            cls.__prop_generation += 1
+        elif base_sec.startswith('romaji_typing_rule/'):
+            cls.__prefs.set_value(base_sec, name, value)
+            romaji.RomajiSegment._update_romaji_typing_rule(base_sec,
+                                                            name, value)
+        elif base_sec.startswith('kana_typing_rule/'):
+            cls.__prefs.set_value(base_sec, name, value)
+            kana.KanaSegment._update_kana_typing_rule(base_sec, name, value)
         elif base_sec.startswith('dict/file/'):
             if base_sec not in cls.__prefs.sections():
                 cls._fetch_dict_values(base_sec)
             cls.__prefs.set_value(base_sec, name, value)
+            cls.__conversion_cache.clear()
+            cls.__prop_generation += 1
         elif base_sec:
             cls.__prefs.set_value(base_sec, name, value)
         else:
@@ -1940,6 +2541,12 @@ class Engine(ibus.EngineBase):
         if not self._chk_mode('14'):
             return False
 
+        if self.__convert_mode == CONV_MODE_OFF:
+            key = self.__get_conversion_key()
+            if key not in Engine.__conversion_cache and \
+               self.__convert_in_worker(key, True):
+                return True
+
         self.__begin_anthy_convert()
         self.__invalidate()
 
@@ -1951,19 +2558,12 @@ class Engine(ibus.EngineBase):
 
         text, cursor = self.__preedit_ja_string.get_hiragana(True)
 
-        self.__context.set_prediction_string(text.encode("utf8"))
-        ps = anthy.anthy_prediction_stat()
-        self.__context.get_prediction_stat(ps)
-
-#        for i in range(ps.nr_prediction):
-#            print self.__context.get_prediction(i)
-
-        buf = self.__context.get_prediction(0)
-        if not buf:
+        predictions = self.__prediction.get_predictions(text)
+        if not predictions:
             return False
 
-        text = unicode(buf, "utf-8")
-        self.__segments.append((0, text))
+        self.__segments.append((0, unicode(predictions[0], "utf-8")))
+        self.__segment_readings.append(text)
 
         self.__convert_mode = CONV_MODE_PREDICTION
         self.__cursor_pos = 0
@@ -2004,19 +2604,47 @@ class Engine(ibus.EngineBase):
         if clipboard_text == None:
             return False
 
-        self.__convert_chars = unicode (clipboard_text, "utf-8")
-        for i in xrange(0, len(self.__convert_chars)):
-            keyval = self.__convert_chars[i]
-            self.__preedit_ja_string.insert(unichr(ord (keyval)))
+        text = unicode (clipboard_text, "utf-8")
+        conversion_worker = self.__get_worker()
+        if conversion_worker != None:
+            conversion_worker.convert(text, False,
+                                      self.__lookup_table.get_page_size(),
+                                      self.__worker_reconverted,
+                                      (self.__worker_serial, text))
+            return True
 
-        self.__context.set_string(self.__convert_chars.encode("utf-8"))
-        conv_stat = anthy.anthy_conv_stat()
-        self.__context.get_stat(conv_stat)
+        segments = self.__context.set_string_segments(text.encode("utf-8"))
+        self.__reconvert(text, convcache.ConversionSnapshot(segments), False)
+        return True
 
-        for i in xrange(0, conv_stat.nr_segment):
-            buf = self.__context.get_segment(i, 0)
-            text = unicode(buf, "utf-8")
-            self.__segments.append((0, text))
+    def __worker_reconverted(self, result, data):
+        serial, text = data
+        # the user typed while the worker converted the text.
+        if serial != self.__worker_serial or \
+           not self.__preedit_ja_string.is_empty():
+            return
+        if result == None:
+            # the text is inserted unconverted as in __worker_converted.
+            self.__preedit_ja_string.insert_string(text)
+            self.__invalidate()
+            return
+        self.__reconvert(text, convcache.ConversionSnapshot(*result), True)
+
+    def __reconvert(self, text, snapshot, in_worker):
+        self.__convert_chars = text
+        self.__preedit_ja_string.insert_string(self.__convert_chars)
+
+        # the snapshot is not in the conversion cache.
+        self.__snapshot = None
+        self.__candidates = snapshot.candidates
+        self.__context_text = None
+        # the context was converted with the text if not in_worker.
+        self.__context_string = None
+        if in_worker:
+            # the context is converted when it is needed.
+            self.__context_text = text
+            self.__context_single = False
+        self.__set_segments(snapshot.segments)
 
         self.__convert_mode = CONV_MODE_ANTHY
         self.__cursor_pos = 0
@@ -2024,8 +2652,6 @@ class Engine(ibus.EngineBase):
         self.__lookup_table_visible = False
         self.__invalidate()
 
-        return True
-
 #    def __cmd_do_nothing(self, keyval, state):
 #        return True
 
@@ -2101,37 +2727,36 @@ class Engine(ibus.EngineBase):
             self.__shrink_segment(1)
             return True
 
-    def __move_cursor_char_length(self, length):
-        if self.__input_mode == INPUT_MODE_HIRAGANA:
-            self.__preedit_ja_string.move_cursor_hiragana_length(length)
-        elif self.__input_mode == INPUT_MODE_KATAKANA:
-            self.__preedit_ja_string.move_cursor_katakana_length(length)
-        elif self.__input_mode == INPUT_MODE_HALF_WIDTH_KATAKANA:
-            self.__preedit_ja_string.move_cursor_half_with_katakana_length(length)
-        else:
-            self.__preedit_ja_string.move_cursor(length)
-
     def __commit_nth_segment(self, commit_index, keyval, state):
 
         if commit_index >= len(self.__segments):
             return False
 
         if self.__convert_mode == CONV_MODE_ANTHY:
+            if self.__sync_context():
+                # the user sees the segments of the context first.
+                self.__lookup_table_visible = False
+                self.__fill_lookup_table()
+                self.__invalidate()
+                return True
+            self.__context_string = None
             for i in xrange(0, commit_index + 1):
                 (seg_index, text) = self.__segments[i]
                 self.commit_text(ibus.Text(text))
+                self.__context.commit_segment(i + self.__segment_offset,
+                                              seg_index)
 
-            text, cursor = self.__get_preedit()
-            commit_length = 0
-            for i in xrange(0, commit_index + 1):
-                buf = self.__context.get_segment(i, NTH_UNCONVERTED_CANDIDATE)
-                commit_length += len(unicode(buf, "utf-8"))
-            self.__move_cursor_char_length(commit_length - cursor)
-            for i in xrange(0, commit_length):
-                self.__preedit_ja_string.remove_before()
-            self.__move_cursor_char_length(cursor - commit_length)
+            commit_length = self.__get_readings_length(0, commit_index + 1)
+            self.__preedit_ja_string.delete_range(0, commit_length)
 
             del self.__segments[0:commit_index + 1]
+            del self.__segment_readings[0:commit_index + 1]
+            # the rest of the segments and the selected candidates
+            # are kept in the context.
+            self.__segment_offset += commit_index + 1
+            # anthy learns when the last segment is committed.
+            if len(self.__segments) == 0:
+                self.__clear_learned_caches()
 
         if len(self.__segments) == 0:
             self.__reset()
@@ -2142,7 +2767,12 @@ class Engine(ibus.EngineBase):
                 self.__cursor_pos = 0
             text, cursor = self.__get_preedit()
             self.__convert_chars = text
-            self.__context.set_string(text.encode ("utf-8"))
+            if self.__convert_mode != CONV_MODE_ANTHY:
+                self.__context.set_string(text.encode ("utf-8"))
+                self.__context_string = None
+                self.__snapshot = None
+                self.__candidates = {}
+                self.__context_text = None
 
         self.__lookup_table.clean()
         self.__lookup_table.show_cursor (False)
@@ -2297,7 +2927,8 @@ class Engine(ibus.EngineBase):
 
     def __convert_segment_to_kana(self, n):
         if self.__convert_mode == CONV_MODE_ANTHY and -4 <= n <= -2:
-            buf = self.__context.get_segment(self.__cursor_pos, n)
+            self.__sync_context()
+            buf = self.__context.get_segment(self.__get_context_pos(), n)
             self.__segments[self.__cursor_pos] = n, unicode(buf, "utf-8")
             self.__lookup_table_visible = False
             self.__invalidate()
@@ -2352,10 +2983,8 @@ class Engine(ibus.EngineBase):
 
     def __convert_segment_to_latin(self, n):
         if self.__convert_mode == CONV_MODE_ANTHY and n in [-100, -101]:
-            start = 0
-            for i in range(self.__cursor_pos):
-                start += len(unicode(self.__context.get_segment(i, NTH_UNCONVERTED_CANDIDATE), 'utf-8'))
-            end = start + len(unicode(self.__context.get_segment(self.__cursor_pos, NTH_UNCONVERTED_CANDIDATE), 'utf-8'))
+            start = self.__get_readings_length(0, self.__cursor_pos)
+            end = start + len(self.__segment_readings[self.__cursor_pos])
             i, s = self.__segments[self.__cursor_pos]
             s2 = self.__preedit_ja_string.get_raw(start, end)
             if n == -101:
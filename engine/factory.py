@@ -21,8 +21,10 @@
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import ibus
+import ctxpool
 import engine
 import os
+import time
 
 from gettext import dgettext
 _  = lambda a : dgettext("ibus-anthy", a)
@@ -44,6 +46,7 @@ class EngineFactory(ibus.EngineFactoryBase):
         super(EngineFactory, self).__init__(bus)
 
         self.__id = 0
+        self.__context_pool = ctxpool.ContextPool()
         self.__config = self.__bus.get_config()
 
         self.__config.connect("reloaded", self.__config_reloaded_cb)
@@ -52,10 +55,22 @@ class EngineFactory(ibus.EngineFactoryBase):
     def create_engine(self, engine_name):
         if engine_name == "anthy":
             self.__id += 1
-            return engine.Engine(self.__bus, "%s/%d" % (self.ENGINE_PATH, self.__id))
+            start = time.time()
+            e = engine.Engine(self.__bus, "%s/%d" % (self.ENGINE_PATH, self.__id),
+                              self.__context_pool)
+            if engine.DEBUG:
+                print 'CREATE_ENGINE = %.1fms, %d idle contexts' % \
+                      ((time.time() - start) * 1000, len(self.__context_pool))
+            return e
 
         return super(EngineFactory, self).create_engine(engine_name)
 
+    def do_destroy(self):
+        super(EngineFactory, self).do_destroy()
+        engine.Engine.STOP_WORKER()
+        engine.Engine.REMOVE_DICT_FILES()
+        self.__context_pool.clear()
+
     def __config_reloaded_cb(self, config):
         engine.Engine.CONFIG_RELOADED(self.__bus)
 
@@ -20,6 +20,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+from operator import methodcaller
+
 import romaji
 import kana
 import thumb
@@ -47,7 +49,174 @@ TYPING_MODE_ROMAJI, \
 TYPING_MODE_KANA, \
 TYPING_MODE_THUMB_SHIFT = range(3)
 
+_chk_text_table_cache = {}
+
+# Returns the translate table of JaString._chk_text() which is composed of
+# PeriodTable, SymbolTable, HalfSymbolTable and HalfNumberTable.
+def get_chk_text_table(period, symbol, half_symbol, half_number):
+    key = (bool(period), symbol, bool(half_symbol), bool(half_number))
+    if key in _chk_text_table_cache:
+        return _chk_text_table_cache[key]
+    tables = []
+    if period:
+        tables.append(PeriodTable)
+    if symbol:
+        tables.append(SymbolTable[symbol])
+    if half_symbol:
+        tables.append(HalfSymbolTable)
+    if half_number:
+        tables.append(HalfNumberTable)
+    chars = set()
+    for t in tables:
+        chars.update(t.keys())
+    table = {}
+    for c in chars:
+        ret = c
+        for t in tables:
+            ret = t.get(ret, ret)
+        if ret != c:
+            table[ord(c)] = unicode(ret)
+    _chk_text_table_cache[key] = table
+    return table
+
+class LengthIndex(object):
+    # A Fenwick tree of the text lengths of the segments.
+    # The offset of a segment and the segment of an offset are
+    # found in O(log n).  The segments removed from the head are kept
+    # as empty slots until they are the half of the tree.
+    def __init__(self, lengths=[]):
+        self.__tree = [0]
+        self.__base = 0
+        self.replace_from(0, lengths)
+
+    def __len__(self):
+        return len(self.__tree) - 1 - self.__base
+
+    # Replaces the lengths of the segments from index.  Only the nodes
+    # after index are built again.
+    def replace_from(self, index, lengths):
+        tree = self.__tree
+        i = index + self.__base
+        del tree[i + 1:]
+        tree.extend(lengths)
+        size = len(tree)
+        # the nodes before index whose ranges end after index.
+        j = i
+        while j > 0:
+            k = j + (j & -j)
+            if k < size:
+                tree[k] += tree[j]
+            j -= j & -j
+        for j in xrange(i + 1, size):
+            k = j + (j & -j)
+            if k < size:
+                tree[k] += tree[j]
+
+    # Removes the first count segments.
+    def remove_head(self, count):
+        offsets = [self.get_offset(i) for i in xrange(count + 1)]
+        for i in xrange(count):
+            self.add(i, offsets[i] - offsets[i + 1])
+        self.__base += count
+        if self.__base * 2 > len(self.__tree):
+            self.__compact()
+
+    def __compact(self):
+        tree = self.__tree
+        # the reverse of the build in replace_from().
+        for j in xrange(len(tree) - 1, 0, -1):
+            k = j + (j & -j)
+            if k < len(tree):
+                tree[k] -= tree[j]
+        lengths = tree[self.__base + 1:]
+        self.__tree = [0]
+        self.__base = 0
+        self.replace_from(0, lengths)
+
+    def add(self, index, delta):
+        tree = self.__tree
+        i = index + self.__base + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    # Returns the total length of the first index segments.
+    def get_offset(self, index):
+        tree = self.__tree
+        index += self.__base
+        offset = 0
+        while index > 0:
+            offset += tree[index]
+            index -= index & -index
+        return offset
+
+    # Returns the largest index whose offset is not greater than offset.
+    def get_index(self, offset):
+        tree = self.__tree
+        size = len(tree) - 1
+        index = 0
+        step = 1
+        while step * 2 <= size:
+            step *= 2
+        while step > 0:
+            if index + step <= size and tree[index + step] <= offset:
+                index += step
+                offset -= tree[index]
+            step /= 2
+        return index - self.__base
+
+class RenderedText(object):
+    # Keeps the rendered text of every segment and the LengthIndex of
+    # the segments so that an edit renders the changed segments only.
+    def __init__(self, conv, segments):
+        self.__conv = conv
+        self.__texts = map(conv, segments)
+        self.__text = u"".join(self.__texts)
+        self.__index = LengthIndex(map(len, self.__texts))
+
+    def splice(self, start, end, segments):
+        texts = map(self.__conv, segments)
+        index = self.__index
+        offset_start = index.get_offset(start)
+        offset_end = index.get_offset(end)
+        text = self.__text
+        self.__text = text[:offset_start] + u"".join(texts) + \
+                      text[offset_end:]
+        if len(texts) == end - start:
+            for i, t in enumerate(texts):
+                index.add(start + i, len(t) - len(self.__texts[start + i]))
+        elif start == 0 and not texts:
+            # the committed segments are removed from the head.
+            index.remove_head(end)
+        else:
+            index.replace_from(start, map(len, texts + self.__texts[end:]))
+        self.__texts[start:end] = texts
+
+    def get_text(self):
+        return self.__text
+
+    def get_offset(self, index):
+        return self.__index.get_offset(index)
+
+    # Returns the index of the segment which starts at offset or
+    # the last segment which starts before offset.
+    def get_index(self, offset):
+        if offset <= 0:
+            return 0
+        return self.__index.get_index(offset)
+
+    # Returns the index of the first segment which starts at offset or
+    # after offset.
+    def get_index_after(self, offset):
+        if offset <= 0:
+            return 0
+        return min(self.__index.get_index(offset - 1) + 1,
+                   len(self.__index))
+
 class JaString:
+    _prefs = None
+    _chk_text_tables = {}
+
     def __init__(self, mode=TYPING_MODE_ROMAJI):
         self.__mode = mode
         self.reset()
@@ -58,6 +227,7 @@ class JaString:
     def reset(self):
         self.__cursor = 0
         self.__segments = list()
+        self.__rendered = {}
         self.__shift = False
 
     def set_mode(self, mode):
@@ -68,14 +238,55 @@ class JaString:
         self.__shift = shift
 
     def insert(self, c):
+        self.insert_string(c)
+
+    def insert_string(self, text):
+        # The unfinished segments next to the cursor can take the chars
+        # so the chars are inserted in the segments around the cursor
+        # and the segments are spliced at once.
+        start = self.__cursor
+        end = self.__cursor
+        if start >= 1 and not self.__segments[start - 1].is_finished():
+            start -= 1
+        if end < len(self.__segments) and \
+           not self.__segments[end].is_finished():
+            end += 1
+        segments = self.__segments[start:end]
+        cursor = self.__cursor - start
+        for c in text:
+            cursor = self.__insert_char(segments, cursor, c)
+        self.__splice(start, end, segments)
+        self.__cursor = start + cursor
+
+    # start and end are the hiragana offsets.
+    def delete_range(self, start, end):
+        self.replace_range(start, end, u"")
+
+    # The segments which start in the hiragana offsets from start to end
+    # are replaced with the segments of text.
+    def replace_range(self, start, end, text):
+        hiragana = self.__get_rendered('to_hiragana')
+        start = hiragana.get_index_after(start)
+        end = max(start, hiragana.get_index_after(end))
+        segments = []
+        cursor = 0
+        for c in text:
+            cursor = self.__insert_char(segments, cursor, c)
+        self.__splice(start, end, segments)
+        if self.__cursor >= end:
+            self.__cursor += len(segments) - (end - start)
+        elif self.__cursor > start:
+            self.__cursor = start + len(segments)
+
+    def __insert_char(self, segments, cursor, c):
         segment_before = None
         segment_after = None
         new_segments = None
 
-        if self.__cursor >= 1:
-            segment_before = self.__segments[self.__cursor - 1]
-        if self.__cursor < len(self.__segments):
-            segment_after = self.__segments[self.__cursor]
+        if cursor >= 1:
+            segment_before = segments[cursor - 1]
+        if cursor < len(segments):
+            segment_after = segments[cursor]
         if segment_before and not segment_before.is_finished():
             if type(segment_before) == romaji.RomajiSegment:
                 new_segments = segment_before.append(c, self.__shift)
@@ -96,8 +307,9 @@ class JaString:
                 elif self.__mode == TYPING_MODE_THUMB_SHIFT:
                     new_segments = [thumb.ThumbShiftSegment(c)]
         if new_segments:
-            self.__segments[self.__cursor:self.__cursor] = new_segments
-            self.__cursor += len(new_segments)
+            segments[cursor:cursor] = new_segments
+            cursor += len(new_segments)
+        return cursor
 
     def remove_before(self):
         index = self.__cursor - 1
@@ -105,8 +317,10 @@ class JaString:
             segment = self.__segments[index]
             segment.pop()
             if segment.is_empty():
-                del self.__segments[index]
+                self.__splice(index, index + 1, [])
                 self.__cursor = index
+            else:
+                self.__splice(index, index + 1, [segment])
             return True
 
         return False
@@ -117,11 +331,33 @@ class JaString:
             segment = self.__segments[index]
             segment.pop()
             if segment.is_empty():
-                del self.__segments[index]
+                self.__splice(index, index + 1, [])
+            else:
+                self.__splice(index, index + 1, [segment])
             return True
 
         return False
 
+    # All the changes of the segments are done here so that
+    # the rendered texts are updated with the changed segments only.
+    def __splice(self, start, end, segments):
+        self.__segments[start:end] = segments
+        for rendered in self.__rendered.values():
+            rendered.splice(start, end, segments)
+
+    def __get_rendered(self, name):
+        rendered = self.__rendered.get(name, None)
+        if rendered == None:
+            rendered = RenderedText(methodcaller(name), self.__segments)
+            self.__rendered[name] = rendered
+        return rendered
+
+    def __get_texts(self, name):
+        rendered = self.__get_rendered(name)
+        text = rendered.get_text()
+        pos = rendered.get_offset(self.__cursor)
+        return text[:pos], text[pos:]
+
     def get_string(self, type):
         pass
 
@@ -134,134 +370,77 @@ class JaString:
 
     # hiragana segments are not char lengths.
     # e.g. 'ya' is 1 segment and 1 char and 'kya' is 1 segment and 2 chars.
+    # The cursor is moved to the segment which starts at the char offset
+    # or the last segment which starts before it.
+    def __move_cursor_length(self, name, length):
+        rendered = self.__get_rendered(name)
+        offset = rendered.get_offset(self.__cursor) + length
+        self.__cursor = rendered.get_index(offset)
+
     def move_cursor_hiragana_length(self, length):
-        delta = length
-        if delta < 0:
-            if self.__cursor >= len(self.__segments):
-                delta = delta + (self.__cursor - len(self.__segments) + 1)
-                self.__cursor = len(self.__segments) - 1
-            while delta < 0:
-                text = unicode(self.__segments[self.__cursor].to_hiragana())
-                if len(text) > -delta:
-                    break
-                delta = delta + len(text)
-                self.__cursor = self.__cursor - 1
-        else:
-            if self.__cursor >= len(self.__segments):
-                self.__cursor = len(self.__segments)
-                return
-            while delta > 0:
-                text = unicode(self.__segments[self.__cursor].to_hiragana())
-                if len(text) > delta:
-                    break
-                delta = delta - len(text)
-                self.__cursor = self.__cursor + 1
+        self.__move_cursor_length('to_hiragana', length)
 
     def move_cursor_katakana_length(self, length):
-        delta = length
-        if delta < 0:
-            if self.__cursor >= len(self.__segments):
-                delta = delta + (self.__cursor - len(self.__segments) + 1)
-                self.__cursor = len(self.__segments) - 1
-            while delta < 0:
-                text = unicode(self.__segments[self.__cursor].to_katanaka())
-                if len(text) > -delta:
-                    break
-                delta = delta + len(text)
-                self.__cursor = self.__cursor - 1
-        else:
-            if self.__cursor >= len(self.__segments):
-                self.__cursor = len(self.__segments)
-                return
-            while delta > 0:
-                text = unicode(self.__segments[self.__cursor].to_katanaka())
-                if len(text) > delta:
-                    break
-                delta = delta - len(text)
-                self.__cursor = self.__cursor + 1
+        self.__move_cursor_length('to_katakana', length)
 
     def move_cursor_half_with_katakana_length(self, length):
-        delta = length
-        if delta < 0:
-            if self.__cursor >= len(self.__segments):
-                delta = delta + (self.__cursor - len(self.__segments) + 1)
-                self.__cursor = len(self.__segments) - 1
-            while delta < 0:
-                text = unicode(self.__segments[self.__cursor].to_half_width_katakana())
-                if len(text) > -delta:
-                    break
-                delta = delta + len(text)
-                self.__cursor = self.__cursor - 1
-        else:
-            if self.__cursor >= len(self.__segments):
-                self.__cursor = len(self.__segments)
-                return
-            while delta > 0:
-                text = unicode(self.__segments[self.__cursor].to_half_width_katakana())
-                if len(text) > delta:
-                    break
-                delta = delta - len(text)
-                self.__cursor = self.__cursor + 1
+        self.__move_cursor_length('to_half_width_katakana', length)
+
+    @classmethod
+    def _reset_chk_text(cls):
+        cls._chk_text_tables = {}
 
     def _chk_text(self, s):
-        period = self._prefs.get_value('common', 'period_style')
-        symbol = self._prefs.get_value('common', 'symbol_style')
-        half_symbol = self._prefs.get_value('common', 'half_width_symbol')
-        half_number = self._prefs.get_value('common', 'half_width_number')
-        ret = ''
-        for c in s:
-            c = c if not period else PeriodTable.get(c, c)
-            # thumb_left + '2' and '/' are different
-            if self.__mode != TYPING_MODE_THUMB_SHIFT:
-                c = c if not symbol else SymbolTable[symbol].get(c, c)
-            c = c if not half_symbol else HalfSymbolTable.get(c, c)
-            c = c if not half_number else HalfNumberTable.get(c, c)
-            ret += c
-        return ret
+        # thumb_left + '2' and '/' are different
+        thumb_shift = (self.__mode == TYPING_MODE_THUMB_SHIFT)
+        table = self._chk_text_tables.get(thumb_shift, None)
+        if table == None:
+            period = self._prefs.get_value('common', 'period_style')
+            symbol = self._prefs.get_value('common', 'symbol_style')
+            half_symbol = self._prefs.get_value('common', 'half_width_symbol')
+            half_number = self._prefs.get_value('common', 'half_width_number')
+            table = get_chk_text_table(period,
+                                       None if thumb_shift else symbol,
+                                       half_symbol, half_number)
+            self._chk_text_tables[thumb_shift] = table
+        return s.translate(table)
 
     def get_hiragana(self, commit=False):
-        conv = lambda s: s.to_hiragana()
         R = lambda s: s if not (commit and s[-1:] == u'n') else s[:-1] + u'ん'
-        text_before = R(u"".join(map(conv, self.__segments[:self.__cursor])))
-        text_after = R(u"".join(map(conv, self.__segments[self.__cursor:])))
+        text_before, text_after = self.__get_texts('to_hiragana')
+        text_before = R(text_before)
+        text_after = R(text_after)
         return self._chk_text(text_before + text_after), len(text_before)
 
     def get_katakana(self, commit=False):
-        conv = lambda s: s.to_katakana()
         R = lambda s: s if not (commit and s[-1:] == u'n') else s[:-1] + u'ン'
-        text_before = R(u"".join(map(conv, self.__segments[:self.__cursor])))
-        text_after = R(u"".join(map(conv, self.__segments[self.__cursor:])))
+        text_before, text_after = self.__get_texts('to_katakana')
+        text_before = R(text_before)
+        text_after = R(text_after)
         return self._chk_text(text_before + text_after), len(text_before)
 
     def get_half_width_katakana(self, commit=False):
-        conv = lambda s: s.to_half_width_katakana()
         R = lambda s: s if not (commit and s[-1:] == u'n') else s[:-1] + u'ﾝ'
-        text_before = R(u"".join(map(conv, self.__segments[:self.__cursor])))
-        text_after = R(u"".join(map(conv, self.__segments[self.__cursor:])))
+        text_before, text_after = self.__get_texts('to_half_width_katakana')
+        text_before = R(text_before)
+        text_after = R(text_after)
         return self._chk_text(text_before + text_after), len(text_before)
 
     def get_latin(self):
-        conv = lambda s: s.to_latin()
-        text_before = u"".join(map(conv, self.__segments[:self.__cursor]))
-        text_after = u"".join(map(conv, self.__segments[self.__cursor:]))
+        text_before, text_after = self.__get_texts('to_latin')
         return text_before + text_after, len(text_before)
 
     def get_wide_latin(self):
-        conv = lambda s: s.to_wide_latin()
-        text_before = u"".join(map(conv, self.__segments[:self.__cursor]))
-        text_after = u"".join(map(conv, self.__segments[self.__cursor:]))
+        text_before, text_after = self.__get_texts('to_wide_latin')
         return text_before + text_after, len(text_before)
 
     def is_empty(self):
         return all(map(lambda s: s.is_empty(), self.__segments))
 
+    # start and end are the hiragana offsets.
     def get_raw(self, start, end):
-        i = 0
-        r = u''
-        for s in self.__segments:
-            if i >= end:
-                break
-            elif start <= i:
-                r += s.to_latin()
-            i += len(s.to_hiragana())
-        return r
+        hiragana = self.__get_rendered('to_hiragana')
+        latin = self.__get_rendered('to_latin')
+        start = latin.get_offset(hiragana.get_index_after(start))
+        end = latin.get_offset(hiragana.get_index_after(end))
+        return latin.get_text()[start:end]
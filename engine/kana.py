@@ -23,14 +23,16 @@
 from ibus import unichar_half_to_full
 from tables import *
 import segment
-import sys
 
 _UNFINISHED_HIRAGANA = set(u"かきくけこさしすせそたちつてとはひふへほ")
 
 class KanaSegment(segment.Segment):
+    __slots__ = ()
+
     _prefs = None
     _kana_typing_rule_section = None
-    
+    _kana_typing_rule = None
+
     def __init__(self, enchars=u"", jachars=u""):
         if not jachars:
             jachars = self.__get_kana_typing_rule(enchars, u"")
@@ -38,42 +40,38 @@ class KanaSegment(segment.Segment):
 
     @classmethod
     def _init_kana_typing_rule(cls, prefs):
+        section = None
+        if prefs != None:
+            method = prefs.get_value('kana_typing_rule', 'method')
+            if method == None:
+                method = 'default'
+            section = 'kana_typing_rule/' + method
+            if section not in prefs.sections():
+                section = None
+        if cls._kana_typing_rule != None and \
+           cls._prefs == prefs and cls._kana_typing_rule_section == section:
+            return
         cls._prefs = prefs
-        if prefs == None:
-            cls._kana_typing_rule_section = None
+        cls._kana_typing_rule_section = section
+        if section == None:
+            cls._kana_typing_rule = kana_typing_rule_static
+        else:
+            cls._kana_typing_rule = segment.load_typing_rule(prefs,
+                                                             'kana_typing_rule',
+                                                             section)
+
+    @classmethod
+    def _update_kana_typing_rule(cls, section, key, value):
+        if section != cls._kana_typing_rule_section:
             return
-        method = prefs.get_value('kana_typing_rule', 'method')
-        if method == None:
-            method = 'default'
-        cls._kana_typing_rule_section = 'kana_typing_rule/' + method
-        if cls._kana_typing_rule_section not in prefs.sections():
-            cls._kana_typing_rule_section = None
+        k, value = segment.decode_typing_rule_item(key, value)
+        if k != None:
+            cls._kana_typing_rule[k] = value
+        else:
+            cls._kana_typing_rule.pop(unicode(str(key)), None)
 
     def __get_kana_typing_rule(self, enchars, retval=None):
-        prefs = self._prefs
-        value = None
-        section = self._kana_typing_rule_section
-        if section != None:
-            try:
-                # U+A5 needs to be UTF-8 since gconf values are
-                # disk saved values.
-                enchars = enchars.encode('utf-8')
-            except:
-                print >> sys.stderr, \
-                    "Failed to encode UTF-8:", enchars
-            if enchars in prefs.keys(section):
-                value = unicode(str(prefs.get_value(section, enchars)))
-            else:
-                value = prefs.get_value_direct(section, enchars)
-                if value != None:
-                    value = unicode(str(value))
-            if value == '':
-                value = None
-            if value == None:
-                value = retval 
-        else:
-            value = kana_typing_rule_static.get(enchars, retval)
-        return value
+        return self._kana_typing_rule.get(enchars, retval)
 
     def is_finished(self):
         return not (self._jachars in _UNFINISHED_HIRAGANA)
@@ -24,6 +24,7 @@ import os
 import sys
 import getopt
 import ibus
+import engine
 import factory
 import gobject
 import locale
@@ -47,6 +48,9 @@ class IMApp:
         self.__bus = ibus.Bus()
         self.__bus.connect("disconnected", self.__bus_disconnected_cb)
         self.__factory = factory.EngineFactory(self.__bus)
+        # The conversion servers are started after the factory loads
+        # the preferences.
+        engine.Engine.START_CONVERSION_SERVERS()
         if exec_by_ibus:
             self.__bus.request_name("org.freedesktop.IBus.Anthy", 0)
         else:
@@ -54,6 +58,8 @@ class IMApp:
 
     def run(self):
         self.__mainloop.run()
+        engine.Engine.STOP_CONVERSION_SERVERS()
+        engine.Engine.STOP_WORKER()
 
     def __bus_disconnected_cb(self, bus):
         self.__mainloop.quit()
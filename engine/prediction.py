@@ -0,0 +1,86 @@
+# vim:set et sts=4 sw=4:
+# -*- coding: utf-8 -*-
+#
+# ibus-anthy - The Anthy engine for IBus
+#
+# Copyright (c) 2007-2008 Peng Huang <shawn.p.huang@gmail.com>
+# Copyright (c) 2007-2011 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# The number of the readings which are kept in a PredictionSession.
+PREDICTION_CACHE_SIZE = 64
+
+class PredictionSession(object):
+    # The predictions of the readings are cached until a prediction is
+    # committed.  The predictions of a reading are a subset of the
+    # predictions of its prefixes, so a reading is not looked up if one
+    # of its prefixes has no predictions.  anthy does not return the
+    # readings of the predictions, so a longer reading cannot be narrowed
+    # from the candidates of its prefix.
+    def __init__(self, context, size=PREDICTION_CACHE_SIZE):
+        self.__context = context
+        self.__size = size
+        self.__predictions = {}
+        self.__reading = None
+        self.__context_reading = None
+
+    def get_predictions(self, reading=None):
+        if reading == None:
+            reading = self.__reading
+        if reading == None:
+            return []
+        self.__reading = reading
+        predictions = self.find_predictions(reading)
+        if predictions == None:
+            self.__set_context_reading(reading)
+            predictions = self.__context.get_predictions()
+            self.add_predictions(reading, predictions)
+        return predictions
+
+    # Returns the cached predictions of the reading or None.
+    def find_predictions(self, reading):
+        predictions = self.__predictions.get(reading, None)
+        if predictions != None:
+            return predictions
+        for i in xrange(len(reading) - 1, 0, -1):
+            if self.__predictions.get(reading[:i], None) == []:
+                return []
+        return None
+
+    def add_predictions(self, reading, predictions):
+        if len(self.__predictions) >= self.__size:
+            self.__predictions.clear()
+        self.__predictions[reading] = predictions
+
+    def __set_context_reading(self, reading):
+        if self.__context_reading == reading:
+            return
+        self.__context.set_prediction_string(reading.encode("utf8"))
+        self.__context_reading = reading
+
+    def commit(self, nth):
+        if self.__reading == None:
+            return -1
+        self.__set_context_reading(self.__reading)
+        retval = self.__context.commit_prediction(nth)
+        # the learning changes the predictions.
+        self.clear()
+        return retval
+
+    # The reading is kept so that the shown predictions can be committed.
+    def clear(self):
+        self.__predictions.clear()
+        self.__context_reading = None
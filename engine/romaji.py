@@ -23,60 +23,152 @@
 from ibus import unichar_half_to_full
 from tables import *
 import segment
-import sys
 
 def romaji_correction_rule_get(k, d):
     return (u'ん', k[1:2]) if k[0:1] == u'n' and not k[1:2] in u"aiueony'" else d
 
+# The longest slice of the preedit which is matched against the rules
+# when the whole text is not a rule.
+_MAX_SLICE_LENGTH = 4
+
+class RomajiTypingRule(object):
+    # The typing rule, symbol_rule and romaji_double_consonat_typing_rule
+    # are merged into one table and the keys are saved in a trie and
+    # a reversed trie so that a key press walks at most
+    # _MAX_SLICE_LENGTH nodes instead of probing every table with
+    # every slice of the preedit.
+    def __init__(self, typing_rule):
+        self.__typing_rule = dict(typing_rule)
+        self.__jachars = {}
+        self.__rules = {}
+        self.__trie = {}
+        self.__rtrie = {}
+        keys = set(romaji_double_consonat_typing_rule.keys())
+        keys.update(symbol_rule.keys())
+        keys.update(self.__typing_rule.keys())
+        for k in keys:
+            self.__update_key(k)
+
+    # The custom rule is updated in place when the config is changed.
+    def set_typing_rule(self, enchars, jachars):
+        if jachars:
+            self.__typing_rule[enchars] = jachars
+        elif enchars in self.__typing_rule:
+            del self.__typing_rule[enchars]
+        self.__update_key(enchars)
+
+    def __update_key(self, k):
+        jachars = self.__typing_rule.get(k, None)
+        if not jachars:
+            jachars = symbol_rule.get(k, None)
+        if jachars:
+            self.__jachars[k] = jachars
+            rule = (jachars, None)
+        else:
+            self.__jachars.pop(k, None)
+            rule = romaji_double_consonat_typing_rule.get(k, None)
+        if rule != None:
+            self.__rules[k] = rule
+        else:
+            self.__rules.pop(k, None)
+        self.__set_node(self.__trie, k, rule)
+        self.__set_node(self.__rtrie, k[::-1], rule)
+
+    def __set_node(self, node, key, rule):
+        for c in key:
+            node = node.setdefault(c, {})
+        if rule != None:
+            node[None] = rule
+        else:
+            node.pop(None, None)
+
+    def get_jachars(self, enchars, retval=None):
+        return self.__jachars.get(enchars, retval)
+
+    # Returns (jachars, None) if text is a typing rule or
+    # (jachars, the rest of enchars) if text is split.
+    def lookup(self, text):
+        rule = self.__rules.get(text, None)
+        if rule == None:
+            rule = romaji_correction_rule_get(text, None)
+        return rule
+
+    # Returns (i, jachars, rest) of the longest rule in text[i:].
+    def match_tail(self, text):
+        match = None
+        node = self.__rtrie
+        for i in xrange(1, min(_MAX_SLICE_LENGTH, len(text)) + 1):
+            rule = None
+            if node != None:
+                node = node.get(text[-i], None)
+                if node != None:
+                    rule = node.get(None, None)
+            if rule == None and text[-i] == u'n':
+                rule = romaji_correction_rule_get(text[-i:], None)
+            if rule != None:
+                match = (-i, rule[0], rule[1])
+        return match
+
+    # Returns (i, jachars, rest) of the longest rule in text[:i].
+    def match_head(self, text):
+        match = None
+        node = self.__trie
+        for i in xrange(1, min(_MAX_SLICE_LENGTH, len(text)) + 1):
+            rule = None
+            if node != None:
+                node = node.get(text[i - 1], None)
+                if node != None:
+                    rule = node.get(None, None)
+            if rule == None and text[0] == u'n':
+                rule = romaji_correction_rule_get(text[:i], None)
+            if rule != None:
+                match = (i, rule[0], rule[1])
+        return match
+
+
 class RomajiSegment(segment.Segment):
+    __slots__ = ()
+
     _prefs = None
     _romaji_typing_rule_section = None
+    _romaji_typing_rule = None
 
     def __init__(self, enchars=u"", jachars=u"", shift=False):
         if not jachars and not shift:
-            jachars = self.__get_romaji_typing_rule(enchars, None)
-            if jachars == None:
-                jachars = symbol_rule.get(enchars, u"")
+            jachars = self._romaji_typing_rule.get_jachars(enchars, u"")
         super(RomajiSegment, self).__init__(enchars, jachars)
 
     @classmethod
     def _init_romaji_typing_rule(cls, prefs):
-        cls._prefs = prefs
-        if prefs == None:
-            cls._romaji_typing_rule_section = None
+        section = None
+        if prefs != None:
+            method = prefs.get_value('romaji_typing_rule', 'method')
+            if method == None:
+                method = 'default'
+            section = 'romaji_typing_rule/' + method
+            if section not in prefs.sections():
+                section = None
+        if cls._romaji_typing_rule != None and \
+           cls._prefs == prefs and cls._romaji_typing_rule_section == section:
             return
-        method = prefs.get_value('romaji_typing_rule', 'method')
-        if method == None:
-            method = 'default'
-        cls._romaji_typing_rule_section = 'romaji_typing_rule/' + method
-        if cls._romaji_typing_rule_section not in prefs.sections():
-            cls._romaji_typing_rule_section = None
-
-    def __get_romaji_typing_rule(self, enchars, retval=None):
-        prefs = self._prefs
-        value = None
-        section = self._romaji_typing_rule_section
-        if section != None:
-            try:
-                # U+A5 needs to be UTF-8 since gconf values are
-                # disk saved values.
-                enchars = enchars.encode('utf-8')
-            except:
-                print >> sys.stderr, \
-                    "Failed to encode UTF-8:", enchars
-            if enchars in prefs.keys(section):
-                value = unicode(str(prefs.get_value(section, enchars)))
-            else:
-                value = prefs.get_value_direct(section, enchars)
-                if value != None:
-                    value = unicode(str(value))
-            if value == '':
-                value = None
-            if value == None:
-                value = retval 
+        cls._prefs = prefs
+        cls._romaji_typing_rule_section = section
+        if section == None:
+            typing_rule = romaji_typing_rule_static
         else:
-            value = romaji_typing_rule_static.get(enchars, retval)
-        return value
+            typing_rule = segment.load_typing_rule(prefs,
+                                                   'romaji_typing_rule',
+                                                   section)
+        cls._romaji_typing_rule = RomajiTypingRule(typing_rule)
+
+    @classmethod
+    def _update_romaji_typing_rule(cls, section, key, value):
+        if section != cls._romaji_typing_rule_section:
+            return
+        k, value = segment.decode_typing_rule_item(key, value)
+        if k == None:
+            k, value = unicode(str(key)), None
+        cls._romaji_typing_rule.set_typing_rule(k, value)
 
     def is_finished(self):
         return self._jachars != u""
@@ -92,54 +184,27 @@ class RomajiSegment(segment.Segment):
             self._enchars = text
             return []
 
-        jachars = self.__get_romaji_typing_rule(text, None)
-        if jachars == None:
-            jachars = symbol_rule.get(text, None)
-        if jachars:
-            self._enchars = text
+        rule = self._romaji_typing_rule.lookup(text)
+        if rule:
+            jachars, c = rule
             self._jachars = jachars
-            return []
-
-        jachars, c = romaji_double_consonat_typing_rule.get(text, (None, None))
-        if jachars:
-            self._enchars = text[0]
-            self._jachars = jachars
-            return [RomajiSegment(c)]
-
-#        jachars, c = romaji_correction_rule.get(text, (None, None))
-        jachars, c = romaji_correction_rule_get(text, (None, None))
-        if jachars:
+            if c == None:
+                self._enchars = text
+                return []
             self._enchars = text[0]
-            self._jachars = jachars
             return [RomajiSegment(c)]
 
-        for i in range(-min(4, len(text)), 0):
+        match = self._romaji_typing_rule.match_tail(text)
+        if match:
+            i, jachars, c = match
             enchars = text[i:]
-
-            jachars = self.__get_romaji_typing_rule(enchars, None)
-            if jachars == None:
-                jachars = symbol_rule.get(enchars, None)
-            if jachars:
-                jasegment = RomajiSegment(enchars, jachars)
-                self._enchars = text[:i]
-                return [jasegment]
-
-            jachars, c = romaji_double_consonat_typing_rule.get(enchars, (None, None))
-            if jachars:
-                jasegment = RomajiSegment(enchars[:-len(c)], jachars)
-                self._enchars = text[:i]
-                if c:
-                    return [jasegment, RomajiSegment(c)]
-                return [jasegment]
-
-#            jachars, c = romaji_correction_rule.get(enchars, (None, None))
-            jachars, c = romaji_correction_rule_get(enchars, (None, None))
-            if jachars:
-                jasegment = RomajiSegment(enchars[:-len(c)], jachars)
-                self._enchars = text[:i]
-                if c:
-                    return [jasegment, RomajiSegment(c)]
-                return [jasegment]
+            self._enchars = text[:i]
+            if c == None:
+                return [RomajiSegment(enchars, jachars)]
+            jasegment = RomajiSegment(enchars[:-len(c)], jachars)
+            if c:
+                return [jasegment, RomajiSegment(c)]
+            return [jasegment]
 
         self._enchars = text
         return []
@@ -156,46 +221,25 @@ class RomajiSegment(segment.Segment):
             self._enchars = text
             return []
 
-        jachars = self.__get_romaji_typing_rule(text, None)
-        if jachars == None:
-            jachars = symbol_rule.get(text, None)
-        if jachars:
-            self._enchars = text
-            self._jachars = jachars
-            return []
-
-        jachars, c = romaji_double_consonat_typing_rule.get(text, (None, None))
-        if jachars:
-            self._enchars = c
-            return [RomajiSegment(text[0], jachars)]
-
-#        jachars, c = romaji_correction_rule.get(text, (None, None))
-        jachars, c = romaji_correction_rule_get(text, (None, None))
-        if jachars:
+        rule = self._romaji_typing_rule.lookup(text)
+        if rule:
+            jachars, c = rule
+            if c == None:
+                self._enchars = text
+                self._jachars = jachars
+                return []
             self._enchars = c
             return [RomajiSegment(text[0], jachars)]
 
-        for i in range(min(4, len(text)), 0, -1):
+        match = self._romaji_typing_rule.match_head(text)
+        if match:
+            i, jachars, c = match
             enchars = text[:i]
-
-            jachars = self.__get_romaji_typing_rule(enchars, None)
-            if jachars == None:
-                jachars = symbol_rule.get(enchars, None)
-            if jachars:
-                jasegment = RomajiSegment(enchars, jachars)
+            if c == None:
                 self._enchars = text[i:]
-                return [jasegment]
-
-            jachars, c = romaji_double_consonat_typing_rule.get(enchars, (None, None))
-            if jachars:
-                self._enchars = c + text[i:]
-                return [RomajiSegment(enchars[:-len(c)], jachars)]
-
-#            jachars, c = romaji_correction_rule.get(enchars, (None, None))
-            jachars, c = romaji_correction_rule_get(enchars, (None, None))
-            if jachars:
-                self._enchars = c + text[i:]
-                return [RomajiSegment(enchars[:-len(c)], jachars)]
+                return [RomajiSegment(enchars, jachars)]
+            self._enchars = c + text[i:]
+            return [RomajiSegment(enchars[:-len(c)], jachars)]
 
         self._enchars = text
         return []
@@ -212,9 +256,7 @@ class RomajiSegment(segment.Segment):
             enchars = list(self._enchars)
             del enchars[index]
             self._enchars = u"".join(enchars)
-            jachars = self.__get_romaji_typing_rule(self._enchars, None)
-            if jachars == None:
-                jachars = symbol_rule.get(self._enchars, u"")
-            self._jachars = jachars
+            self._jachars = \
+                self._romaji_typing_rule.get_jachars(self._enchars, u"")
 
 
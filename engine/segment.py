@@ -23,15 +23,75 @@
 #from ibus import unichar_half_to_full
 from ibus import unichar_half_to_full as h_to_f
 from tables import *
+import sys
 
 def unichar_half_to_full(c):
     tdl = {'"': u'\u201d', "'": u'\u2019', '`': u'\u2018'}
     return tdl[c] if c in tdl else h_to_f(c)
 
+def decode_typing_rule_item(key, value):
+    # config.set_value(key, None) is not supported.
+    if value == None or value == '':
+        return None, None
+    try:
+        # U+A5 is saved with UTF-8 since gconf values are
+        # disk saved values.
+        return unicode(str(key)), unicode(str(value))
+    except:
+        print >> sys.stderr, \
+            "Failed to decode UTF-8:", key
+        return None, None
+
+# Loads the custom typing rule section at once so that the key events
+# do not call prefs.get_value_direct(). The keys which exist in gconf
+# only are saved in the newkeys list of section_base.
+def load_typing_rule(prefs, section_base, section):
+    rule = {}
+    for k in prefs.keys(section):
+        rule[k] = prefs.get_value(section, k)
+    for k in prefs.get_value(section_base, 'newkeys'):
+        if k not in rule:
+            rule[k] = prefs.get_value_direct(section, k)
+    typing_rule = {}
+    for k, value in rule.items():
+        k, value = decode_typing_rule_item(k, value)
+        if k != None:
+            typing_rule[k] = value
+    return typing_rule
+
+# The translate tables of unicode.translate() for the converted segments.
+KatakanaTable = dict((ord(k), v[0])
+                     for k, v in hiragana_katakana_table.items())
+HalfWidthKatakanaTable = dict((ord(k), v[1])
+                              for k, v in hiragana_katakana_table.items())
+WideLatinTable = dict((i, unichar_half_to_full(unichr(i)))
+                      for i in range(0x20, 0x7f))
+
+# The short enchars and jachars are shared by the segments.  The table
+# stops growing when it is full so that it stays bounded while the
+# engine runs, and the chars which are typed first stay in it.
+_INTERN_MAX_LENGTH = 4
+_INTERN_MAX_SIZE = 4096
+_interned_chars = {}
+
+def intern_chars(chars):
+    if len(chars) > _INTERN_MAX_LENGTH:
+        return chars
+    interned = _interned_chars.get(chars)
+    if interned != None:
+        return interned
+    if len(_interned_chars) >= _INTERN_MAX_SIZE:
+        return chars
+    _interned_chars[chars] = chars
+    return chars
+
 class Segment(object):
+    # A segment is created for every key event.
+    __slots__ = ('_enchars', '_jachars')
+
     def __init__(self, enchars=u"", jachars=u""):
-        self._enchars = enchars
-        self._jachars = jachars
+        self._enchars = intern_chars(enchars)
+        self._jachars = intern_chars(jachars)
 
     def append(self, enchar):
         raise NotImplementedError("append() is not implemented")
@@ -46,7 +106,7 @@ class Segment(object):
         raise NotImplementedError("is_finised() is not implemented")
 
     def set_enchars(self, enchars):
-        self.enchars = enchars
+        self._enchars = enchars
 
     def get_enchars(self):
         return self._enchars
@@ -64,19 +124,19 @@ class Segment(object):
 
     def to_katakana(self):
         if self._jachars:
-            return u"".join(map(lambda c: hiragana_katakana_table.get(c, (c, c, c))[0], self._jachars))
+            return unicode(self._jachars).translate(KatakanaTable)
         return self._enchars
 
     def to_half_width_katakana(self):
         if self._jachars:
-            return u"".join(map(lambda c: hiragana_katakana_table.get(c, (c, c, c))[1], self._jachars))
+            return unicode(self._jachars).translate(HalfWidthKatakanaTable)
         return self._enchars
 
     def to_latin(self):
         return self._enchars
 
     def to_wide_latin(self):
-        return u"".join(map(unichar_half_to_full, self._enchars))
+        return unicode(self._enchars).translate(WideLatinTable)
 
     def is_empty(self):
         if self._enchars or self._jachars:
@@ -487,6 +487,8 @@ class ThumbShiftKeyboard:
 
 
 class ThumbShiftSegment(segment.Segment):
+    __slots__ = ()
+
     _prefs = None
     _thumb_typing_rule_section_base = None
     _thumb_typing_rule_section = None
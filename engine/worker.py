@@ -0,0 +1,93 @@
+# vim:set et sts=4 sw=4:
+# -*- coding: utf-8 -*-
+#
+# ibus-anthy - The Anthy engine for IBus
+#
+# Copyright (c) 2007-2008 Peng Huang <shawn.p.huang@gmail.com>
+# Copyright (c) 2007-2011 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import Queue
+import sys
+import threading
+import traceback
+import gobject
+import anthy
+
+# Returns the segments and the first size candidates of every segment
+# so that the engine shows the first page without converting the text
+# in its context.
+def _convert(context, text, single, size):
+    if single:
+        segments = context.set_string_single(text.encode("utf8"))
+    else:
+        segments = context.set_string_segments(text.encode("utf8"))
+    candidates = [context.get_segment_candidates(i, 0, size)
+                  for i in xrange(len(segments))]
+    return segments, candidates
+
+def _predict(context, reading):
+    context.set_prediction_string(reading.encode("utf8"))
+    return context.get_predictions()
+
+class ConversionWorker(object):
+    # A thread with its own anthy context runs the requests in order.
+    # The wrapper releases the GIL in libanthy so the main loop keeps
+    # running while a long text is converted.  The callbacks are called
+    # in the main loop with gobject.idle_add() and the engines discard
+    # the results which are out of date.
+    def __init__(self):
+        self.__queue = Queue.Queue()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    # callback(result, data) gets (segments, candidates) of _convert()
+    # or None.
+    def convert(self, text, single, size, callback, data=None):
+        self.__queue.put((_convert, (text, single, size), callback, data))
+
+    # callback(predictions, data) gets the result of
+    # anthy_context.get_predictions() or None.
+    def predict(self, reading, callback, data=None):
+        self.__queue.put((_predict, (reading,), callback, data))
+
+    # The requests in the queue are run before the thread exits.
+    def stop(self):
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        context = anthy.anthy_context()
+        context._set_encoding(anthy.ANTHY_UTF8_ENCODING)
+        while True:
+            request = self.__queue.get()
+            if request == None:
+                break
+            func, args, callback, data = request
+            try:
+                result = func(context, *args)
+            except:
+                traceback.print_exc()
+                result = None
+            gobject.idle_add(self.__done, callback, result, data)
+
+    def __done(self, callback, result, data):
+        try:
+            callback(result, data)
+        except:
+            traceback.print_exc()
+        return False